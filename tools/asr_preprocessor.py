@@ -1,5 +1,5 @@
-import os, glob, shutil, argparse, yaml, re, json
-import librosa
+import os, glob, shutil, argparse, yaml, re, json, time
+import numpy as np
 from tqdm import tqdm
 
 from multiprocessing import Pool
@@ -8,116 +8,385 @@ import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 
 from utils import common_utils as cu
+from utils import index_utils as iu
+from utils import manifest_utils as mu
+from utils import profile_utils as pu
+from utils import schedule_utils as sc
 from utils import script_utils as su
+from utils import transcript_utils as tu
 from utils import wav_utils as wu
 from utils import video_utils as vu
 
 _warning = False
-
-def worker(buff):
-    args = buff['args']
-    metadata = buff['metadata']
+_args = None # set in every pool process by init_worker
+
+# options each output stage depends on. outputs recorded in the manifest are rebuilt when these change.
+_STAGE_OPTIONS = {
+    'wav': ['sample_rate', 'resampler', 'resample_quality', 'volume'],
+    'video': ['track_size', 'track_framerate', 'audio_in_video', 'video_writer', 'video_codec', 'frame_source', 'decode_height', 'sample_rate', 'resampler', 'resample_quality', 'volume'],
+    'txt': ['capitalize', 'apostrophe', 'hypen', 'space_on_abbreviation', 'numeric_format',
+            'default_inaudible_process', 'default_uncertain_process', 'default_diffluency_process', 'default_interjection_process',
+            'interjection_to_word', 'interjection_to_token', 'interjection_to_drop',
+            'inaudible_token', 'uncertain_token', 'diffluency_token', 'interjection_token'],
+}
+
+def plan_segments(metadata, args, output_dir):
     fn = metadata['video_infos']['file_name']
     fidx = metadata['video_infos']['index']
+    plan = []
+    for seg in metadata['segments']:
+        if args.use_vid_index:
+            wav_path, video_path, txt_path = cu.output_destination(str(fidx), seg, output_dir, args.dataset_style)
+        else:
+            wav_path, video_path, txt_path = cu.output_destination(fn, seg, output_dir, args.dataset_style)
+        plan.append({'segment': seg, 'wav_path': wav_path, 'video_path': video_path, 'txt_path': txt_path, 'done': True})
+
+    return plan
+
+
+def stage_configs(args):
+    return {stage: mu.config_hash(args, keys) for stage, keys in _STAGE_OPTIONS.items()}
+
+
+def skip_segment(fn, job, e):
+    print('Error occur while processing the segment. Skip this segment. file: {}, seg idx: {}'.format(fn,job['segment']['segment_index']))
+    print(f'{str(e)}')
+    job['done'] = False
+
+
+def discard_outputs(manifest, job, stage, dataset_style):
+    # outputs of a failed segment are removed with their manifest entries, so a resumed run leaves what a fresh run would.
+    # librispeech transcript files are shared by segments and rewritten without the failed ones instead
+    manifest.remove(job['segment'], stage)
+    if stage=='txt' and dataset_style=='librispeech':
+        return
+    if os.path.isfile(job[stage+'_path']):
+        os.remove(job[stage+'_path'])
+
+
+def init_worker(args):
+    # args are sent once per process instead of with every task
+    global _args
+    _args = args
+    pu.enable(args.profile, pu.profile_dir(args), 'asr_preprocessor')
+
+
+def worker(buff):
+    # buff: {'fn', 'segment_idxs', 'output_dir', 'part', 'shard_num'}, metadata is loaded here rather than sent from the parent
+    args = _args
+    fn = buff['fn']
     output_dir = buff['output_dir']
+    with pu.stage('metadata load'):
+        metadata = iu.load_metadata(args.voxmm_dir, fn, args.metadata_index)
+    segment_idxs = set(buff['segment_idxs'])
+    metadata['segments'] = [seg for seg in metadata['segments'] if seg['segment_index'] in segment_idxs]
     wav_path = os.path.join(args.voxmm_dir,'wav',fn+'.wav')
     vid_path = os.path.join(args.voxmm_dir,'video',fn+'.mp4')
     face_track_path = os.path.join(args.voxmm_dir,'face_track',fn+'.json')
-
-    if not args.no_wav:
-        src_wav, sr = librosa.load(wav_path, sr=args.sample_rate)
-
-    if not args.no_video:
+    plan = plan_segments(metadata, args, output_dir)
+    manifest = mu.Manifest(os.path.join(output_dir,'manifest'), fn, stage_configs(args), args.resume, [seg['segment_index'] for seg in metadata['segments']], buff['part'])
+    result = {'fn': fn, 'output_dir': output_dir, 'part': buff['part'], 'shard_num': buff['shard_num'], 'segment_num': len(plan), 'manifest': manifest.path, 'trans': [], 'write_stats': None, 'resumed': {'wav': 0, 'video': 0, 'txt': 0}, 'profile': None}
+    pu.count('segments', len(plan))
+
+    # outputs completed by an earlier run with the same settings are kept
+    wav_jobs = [] if args.no_wav else [job for job in plan if not manifest.is_done(job['segment'], 'wav', job['wav_path'])]
+    video_jobs = [] if args.no_video else [job for job in plan if not manifest.is_done(job['segment'], 'video', job['video_path'])]
+    result['resumed']['wav'] = 0 if args.no_wav else len(plan)-len(wav_jobs)
+    result['resumed']['video'] = 0 if args.no_video else len(plan)-len(video_jobs)
+
+    audio_cache = wu.Audio_Cache(args.audio_cache_dir, args.audio_cache_size) if args.audio_cache_dir else None
+    if len(wav_jobs)>0 or (len(video_jobs)>0 and args.audio_in_video and not args.no_wav):
+        # segments are read on demand from the file, or from the audio cache, instead of loading the whole recording
+        src_wav = wu.Audio_Source(wav_path, args.sample_rate, args.resampler, args.resample_quality, audio_cache)
+        sr = src_wav.sr
+
+    if len(video_jobs)>0:
         vid_gen = vu.Face_Track_Generator(vid_path, face_track_path, **vars(args))
         if args.audio_in_video:
             if args.no_wav:
-                vid_gen.load_audio_from_path(wav_path, args.sample_rate)
+                vid_gen.load_audio_from_path(wav_path, args.sample_rate, args.resampler, args.resample_quality, audio_cache)
             else:
                 vid_gen.load_audio(src_wav, sr)
 
-    if not args.no_script:
-        script_gen = su.Script_Generator(**vars(args))
+    # wav generation
+    if len(wav_jobs)>0:
+        valid_jobs = []
+        for job in wav_jobs:
+            try:
+                wu.check_bounds(len(src_wav), job['segment']['start'], job['segment']['end'], sr)
+                valid_jobs.append(job)
+            except Exception as e:
+                skip_segment(fn, job, e)
+
+        # all segments of the recording are normalized in one batch, and encoded and written in the background
+        writer = wu.Async_Writer(args.writer_threads, args.writer_queue)
+        futures = []
+        for i, wav in wu.crop_wavs(src_wav, [(job['segment']['start'], job['segment']['end']) for job in valid_jobs], sr, args.volume):
+            futures.append((valid_jobs[i], writer.submit(valid_jobs[i]['wav_path'], wav, sr, 'PCM_24')))
+        result['write_stats'] = writer.close()
+        for job, future in futures:
+            if not future.exception() is None:
+                skip_segment(fn, job, future.exception())
+            else:
+                manifest.add(job['segment'], 'wav', job['wav_path'])
+        for job in wav_jobs:
+            if not job['done']:
+                discard_outputs(manifest, job, 'wav', args.dataset_style)
+        manifest.save()
+
+    # vid generation
+    if len(video_jobs)>0:
+        face_track_jobs = []
+        for job in [job for job in video_jobs if job['done']]:
+            seg = job['segment']
+            if len(seg['face_track'])!=1:
+                print("Zero or multiple face track detected. Skip this segment. file: {}, seg idx: {}".format(fn, seg['segment_index']))
+                job['done'] = False
+                continue
+            os.makedirs(os.path.dirname(job['video_path']),exist_ok=True)
+            face_track_jobs.append(job)
+
+        if args.decode_mode=='sequential':
+            # every selected segment of the video is served from one set of merged decode intervals
+            windows = [(i, job['segment']['face_track'][0]['index'], job['segment']['start'], job['segment']['end'], job['video_path']) for i, job in enumerate(face_track_jobs)]
+            for i, error in vid_gen.write_face_tracks(windows, int(args.decode_gap*vid_gen.fps), args.volume):
+                if not error is None:
+                    skip_segment(fn, face_track_jobs[i], error)
+                else:
+                    manifest.add(face_track_jobs[i]['segment'], 'video', face_track_jobs[i]['video_path'])
+                    manifest.save()
 
-    for seg in metadata['segments']:
-        if args.use_vid_index:
-            wav_path, video_path, txt_path = cu.output_destination(str(fidx), seg, output_dir, args.dataset_style)
         else:
-            wav_path, video_path, txt_path = cu.output_destination(fn, seg, output_dir, args.dataset_style)
-
-        try:
-            # wav generation
-            if not args.no_wav:
-                os.makedirs(os.path.dirname(wav_path),exist_ok=True)
-                wu.crop_wav(src_wav, seg['start'], seg['end'], sr, args.volume, wav_path)
-
-            # vid generation
-            if not args.no_video:
-                os.makedirs(os.path.dirname(video_path),exist_ok=True)
-                if len(seg['face_track'])==1:
-                    vid_gen(seg['face_track'][0]['index'], seg['start'], seg['end'], video_path, args.volume)
-                else:
-                    print("Zero or multiple face track detected. Skip this segment. file: {}, seg idx: {}".format(fn, seg['segment_index']))
+            for job in face_track_jobs:
+                seg = job['segment']
+                try:
+                    vid_gen(seg['face_track'][0]['index'], seg['start'], seg['end'], job['video_path'], args.volume)
+                    manifest.add(seg, 'video', job['video_path'])
+                    manifest.save()
+                except Exception as e:
+                    skip_segment(fn, job, e)
+
+    # failed segments also lose the videos and transcripts earlier runs made of them
+    failed_jobs = [job for job in plan if not job['done']]
+    for job in failed_jobs:
+        if not args.no_video:
+            discard_outputs(manifest, job, 'video', args.dataset_style)
+        if not args.no_script:
+            discard_outputs(manifest, job, 'txt', args.dataset_style)
+    manifest.save()
+
+    # txt generation
+    if not args.no_script:
+        done_jobs = [job for job in plan if job['done']]
+        entries = [manifest.entry(job['segment'], 'txt', job['txt_path']) for job in done_jobs]
+        txt_jobs = [job for job, entry in zip(done_jobs, entries) if entry is None]
+        result['resumed']['txt'] = len(done_jobs)-len(txt_jobs)
+        if len(txt_jobs)>0:
+            with pu.stage('text normalization'):
+                script_gen = su.Script_Generator(**vars(args))
+                scripts = dict(zip([id(job) for job in txt_jobs], script_gen.batch([job['segment']['text'] for job in txt_jobs], [tu.segment_tokens(job['segment']) for job in txt_jobs])))
+
+        if args.dataset_style=='librispeech':
+            # transcript files are rebuilt from every finished segment, so reruns never duplicate lines
+            trans = {}
+            for job in failed_jobs:
+                # a transcript file left with no segments is removed
+                trans.setdefault(job['txt_path'], [])
+            for job, entry in zip(done_jobs, entries):
+                line = entry['line'] if not entry is None else '{} {}\n'.format(os.path.basename(job['wav_path']).replace('flac',''),scripts[id(job)])
+                trans.setdefault(job['txt_path'], []).append((job, line))
+            for txt_path, lines in trans.items():
+                if not buff['part'] is None:
+                    # shards of a file share its transcript files, the parent writes them once every shard is done
+                    result['trans'].append((txt_path, -1, None))
+                    for job, line in lines:
+                        manifest.add(job['segment'], 'txt', txt_path, check_size=False, line=line)
+                        result['trans'].append((txt_path, job['segment']['segment_index'], line))
                     continue
+                if len(lines)==0:
+                    if os.path.isfile(txt_path):
+                        os.remove(txt_path)
+                    continue
+                try:
+                    with pu.stage('text write'):
+                        os.makedirs(os.path.dirname(txt_path),exist_ok=True)
+                        mu.write_text(txt_path, ''.join([line for _, line in lines]))
+                    for job, line in lines:
+                        manifest.add(job['segment'], 'txt', txt_path, check_size=False, line=line)
+                except Exception as e:
+                    for job, _ in lines:
+                        skip_segment(fn, job, e)
+                        manifest.remove(job['segment'], 'txt')
+
+        elif args.dataset_style=='lrs3':
+            for job in txt_jobs:
+                try:
+                    with pu.stage('text write'):
+                        os.makedirs(os.path.dirname(job['txt_path']),exist_ok=True)
+                        with open(job['txt_path'], 'w') as f:
+                            f.write('Text:  {}\n'.format(scripts[id(job)]))
+                    manifest.add(job['segment'], 'txt', job['txt_path'])
+                except Exception as e:
+                    skip_segment(fn, job, e)
+                    manifest.remove(job['segment'], 'txt')
 
-
-            # txt generation
-            if not args.no_script:
-                os.makedirs(os.path.dirname(txt_path),exist_ok=True)
-                if args.dataset_style=='librispeech':
-                    with open(txt_path, 'a') as f:
-                        f.write('{} {}\n'.format(os.path.basename(wav_path).replace('flac',''),script_gen(seg['text'])))
-
-                elif args.dataset_style=='lrs3':
-                    with open(txt_path, 'w') as f:
-                        f.write('Text:  {}\n'.format(script_gen(seg['text'])))
-
-                else:
-                    raise Exception(f"Invalid dataset style input: {style}")
-
-        except Exception as e:
-            print('Error occur while processing the segment. Skip this segment. file: {}, seg idx: {}'.format(fn,seg['segment_index']))
-            print(f'{str(e)}')
-
+        else:
+            raise Exception(f"Invalid dataset style input: {args.dataset_style}")
+        manifest.save()
 
     if 'vid_gen' in locals():
+        vid_gen.close()
         del vid_gen
     if 'src_wav' in locals():
+        src_wav.close()
         del src_wav
     if 'script_gen' in locals():
         del script_gen
+    result['profile'] = pu.collect()
 
+    return result
 
 
-def asr_preprocessor(args):
-    metadata_dir = os.path.join(args.voxmm_dir,'metadata')
-    segment_list_paths = args.segment_list_paths.replace('[','').replace(']','').split(',')
-    cnt = 0
-    buff = []
-    for segment_list_path in segment_list_paths:
+
+def bundle_worker(bundle):
+    with pu.Task():
+        return [worker(buff) for buff in bundle]
+
+
+def selected_spans(index, fn, segment_idxs):
+    # segment index, start and end of the selected segments, read from the metadata index columns for the cost estimate
+    cols = index.columns(fn)
+    keep = np.isin(cols['segment_index'], segment_idxs)
+
+    return [{'segment_index': i, 'start': s, 'end': e} for i, s, e in zip(np.asarray(cols['segment_index'])[keep].tolist(), np.asarray(cols['start'])[keep].tolist(), np.asarray(cols['end'])[keep].tolist())]
+
+
+def segment_lists(args, stream=False):
+    # yields (output dir, file name, segment indices) over the segment lists.
+    # streamed lists are read lazily and must be grouped by file, otherwise each list is loaded and grouped in memory.
+    for segment_list_path in args.segment_list_paths.replace('[','').replace(']','').split(','):
         print(f'\nPreprocessing start for {segment_list_path}')
         output_dir = os.path.join(args.output_dir, os.path.splitext(os.path.basename(segment_list_path))[0])
         os.makedirs(output_dir,exist_ok=True)
+        if stream:
+            segments = cu.iter_segment_list(segment_list_path.strip())
+        else:
+            segments = cu.load_segment_list(segment_list_path.strip()).items()
+        for fn, segment_idxs in segments:
+            yield output_dir, fn, segment_idxs
+
+
+def stream_tasks(args):
+    # one task per file, produced while the segment lists are read, so workers start on the first file right away
+    for output_dir, fn, segment_idxs in segment_lists(args, stream=True):
+        yield [{'fn': fn, 'segment_idxs': segment_idxs, 'output_dir': output_dir, 'part': None, 'shard_num': 1}]
+
+
+def cost_tasks(args):
+    # heaviest work first, heavy files split into shards and light files bundled, so the pool drains evenly.
+    # costs come from the metadata index alone, without parsing metadata JSON or opening videos before the pool starts
+    index = iu.open_index(args.metadata_index)
+    files = []
+    spans = []
+    for output_dir, fn, segment_idxs in segment_lists(args):
+        files.append((output_dir, fn))
+        spans.append((selected_spans(index, fn, segment_idxs), not args.no_video))
+    bundles = sc.schedule(spans, args.num_worker, args.max_shards)
+
+    shard_num = {}
+    for bundle in bundles:
+        for f, _ in bundle:
+            shard_num[f] = shard_num.get(f, 0) + 1
+    part = {}
+    tasks = []
+    for bundle in bundles:
+        tasks.append([])
+        for f, shard in bundle:
+            output_dir, fn = files[f]
+            part[f] = part.get(f, -1) + 1
+            tasks[-1].append({'fn': fn, 'segment_idxs': [spans[f][0][i]['segment_index'] for i in shard], 'output_dir': output_dir,
+                              'part': part[f] if shard_num[f]>1 else None, 'shard_num': shard_num[f]})
+
+    return tasks
+
+
+def finalize_shards(args, results):
+    # merges the part manifests of a file processed in shards and writes its transcript files
+    fn = results[0]['fn']
+    output_dir = results[0]['output_dir']
+    with pu.stage('shard merge'):
+        mu.merge_parts(os.path.join(output_dir,'manifest'), fn, stage_configs(args), args.resume, [result['manifest'] for result in results])
+    trans = {}
+    for txt_path, _, line in sorted([t for result in results for t in result['trans']], key=lambda t: t[1]):
+        trans.setdefault(txt_path, [])
+        if not line is None:
+            trans[txt_path].append(line)
+    for txt_path, lines in trans.items():
+        if len(lines)==0:
+            if os.path.isfile(txt_path):
+                os.remove(txt_path)
+            continue
+        try:
+            with pu.stage('text write'):
+                os.makedirs(os.path.dirname(txt_path),exist_ok=True)
+                mu.write_text(txt_path, ''.join(lines))
+        except Exception as e:
+            print(f'Error occur while writing the transcript file. file: {fn}, path: {txt_path}')
+            print(f'{str(e)}')
+
 
-        segment_dict = cu.load_segment_list(segment_list_path.strip())
-        for fn in segment_dict.keys():
-            with open(os.path.join(metadata_dir,fn+'.json'), 'r') as fm:
-                metadata =  json.load(fm)
-                cu.version_check(metadata['metadata_version'])
-
-            metadata['segments'] = [seg for seg in metadata['segments'] if seg['segment_index'] in segment_dict[fn]]
-            if len(metadata['segments'])>0:
-                buff.append({"args": args, "metadata": metadata, "output_dir": output_dir})
-                cnt += 1
-                
-
-    p = Pool(args.num_worker)
-    with tqdm(total=len(buff)) as pbar:
-        for _ in tqdm(p.imap_unordered(worker,buff)):
-            pbar.update()
+def asr_preprocessor(args):
+    begin = time.time()
+    pu.enable(args.profile)
+    if args.decode_height>0 and args.frame_source!='ffmpeg' and not args.no_video:
+        raise Exception("decode_height needs frame_source: ffmpeg, opencv decodes at source resolution")
+    schedule = args.schedule
+    if schedule=='cost' and not args.metadata_index:
+        print('Cost scheduling needs a metadata index, files are streamed instead')
+        schedule = 'stream'
+    if schedule=='stream':
+        tasks = stream_tasks(args)
+    elif schedule=='cost':
+        with pu.stage('schedule'):
+            tasks = cost_tasks(args)
+    else:
+        raise Exception(f"Invalid schedule: {args.schedule}")
+
+    cnt = 0
+    write_stats = {'files': 0, 'audio_duration': 0, 'bytes': 0, 'write_time': 0}
+    resumed = {'wav': 0, 'video': 0, 'txt': 0}
+    shard_results = {}
+    profiler = pu.Profiler()
+    p = Pool(args.num_worker, initializer=init_worker, initargs=(args,))
+    with tqdm(total=sum([len(bundle) for bundle in tasks]) if isinstance(tasks, list) else None) as pbar:
+        for results in p.imap_unordered(bundle_worker, tasks):
+            for result in results:
+                if result['segment_num']>0 and result['part'] in [None, 0]:
+                    cnt += 1
+                if not result['write_stats'] is None:
+                    for k, v in result['write_stats'].items():
+                        write_stats[k] += v
+                for k, v in result['resumed'].items():
+                    resumed[k] += v
+                profiler += result['profile']
+                if not result['part'] is None:
+                    key = (result['output_dir'], result['fn'])
+                    shard_results.setdefault(key, []).append(result)
+                    if len(shard_results[key])==result['shard_num']:
+                        finalize_shards(args, shard_results.pop(key))
+                pbar.update()
     p.close()
     p.join()
 
     print(f'{cnt} files processed')
+    if args.resume:
+        print(f"- resumed outputs: {resumed['wav']} wav, {resumed['video']} video, {resumed['txt']} script")
+    if write_stats['files']>0:
+        print(f"- wav written: {write_stats['files']} files, {write_stats['audio_duration']/3600:.2f} hrs, {write_stats['bytes']/1024**2:.1f} MB")
+        print(f"- wav write throughput: {write_stats['bytes']/1024**2/max(write_stats['write_time'],1e-9):.1f} MB/s, {write_stats['audio_duration']/max(write_stats['write_time'],1e-9):.0f}x realtime per writer thread")
+    if pu.enabled():
+        profiler += pu.collect()
+        pu.report(profiler, pu.profile_dir(args), 'asr_preprocessor', time.time()-begin, args.num_worker)
     print('='*20)
 
 
@@ -127,14 +396,20 @@ if __name__=="__main__":
 
     parser.add_argument("--config", type=str,   default=None,   help="config YAML file")
     parser.add_argument("--num_worker", type=int,   default=1,   help="number of process")
+    parser.add_argument("--schedule", type=str, choices=['cost','stream'], default="stream", help="stream files in segment list order as the lists are read (requires lists grouped by file), or dispatch them by cost estimated from the metadata index, largest first")
+    parser.add_argument("--max_shards", type=int,   default=8,   help="maximum number of shards a heavy file is split into across workers, 1 to process every file in one piece")
+    parser.add_argument("--profile", type=str, choices=['none','stages','cprofile'], default="none", help="time the processing stages across workers, cprofile also dumps function statistics per worker")
+    parser.add_argument("--profile_dir", type=str,   default="",   help="directory of the profile report and dumps, OUTPUT_DIR/profile if empty")
     
     parser.add_argument("--voxmm_dir", type=str,   default="./VoxMM",   help="VoxMM dataset")
+    parser.add_argument("--metadata_index", type=str,   default="",   help="metadata index built by index_builder, read instead of the metadata JSON files")
     parser.add_argument("--segment_list_paths", type=str,   default="./results/A-ASR/segment_list/test.txt, ./results/A-ASR/segment_list/train.txt",   help="path list of segment list to preproces")
     parser.add_argument("--output_dir", type=str,   default="./results/A-ASR",   help="path for preprocessed results")
     
     # dataset style
     parser.add_argument("--dataset_style", type=str, choices=['librispeech','lrs3'], default="lrs3", help="resulting dataset format")
     parser.add_argument("--use_vid_index", "-vid", action="store_true", help="use video index instead of video name")
+    parser.add_argument("--resume", action="store_true", help="keep outputs recorded in the manifest of a previous run with the same settings")
 
     # script setting
     parser.add_argument("--no_script", action="store_true", help="do not generate script file")
@@ -158,6 +433,12 @@ if __name__=="__main__":
     # wav setting
     parser.add_argument("--no_wav", action="store_true", help="do not generate cropped wav file")
     parser.add_argument("--sample_rate", type=int,   default=16000,   help="sample rate")
+    parser.add_argument("--resampler", type=str, choices=['soxr','scipy','librosa'], default="soxr", help="resampling backend used when the wav sample rate differs from sample_rate")
+    parser.add_argument("--resample_quality", type=str, choices=['low','medium','high','very_high'], default="high", help="resampling quality")
+    parser.add_argument("--audio_cache_dir", type=str,   default="",   help="directory caching resampled audio across runs, disabled if empty. wav files already at sample_rate are read directly")
+    parser.add_argument("--audio_cache_size", type=float,   default=50,   help="maximum size of the audio cache in GB")
+    parser.add_argument("--writer_threads", type=int,   default=4,   help="threads per worker encoding and writing wav files")
+    parser.add_argument("--writer_queue", type=int,   default=16,   help="maximum number of segments waiting to be written per worker")
     parser.add_argument("--volume", type=float,   default=-16,   help="target Audio RMS in dBFS scale")
 
     # video setting
@@ -165,6 +446,13 @@ if __name__=="__main__":
     parser.add_argument("--track_size", type=int,   default=224,   help="size of resulting face track video")
     parser.add_argument("--track_framerate", type=int,   default=25,   help="frame rate of resulting face track video")
     parser.add_argument("--audio_in_video", action="store_true", help="audio in video")
+    parser.add_argument("--decode_mode", type=str, choices=['seek','sequential'], default="sequential", help="seek every frame per segment, or decode each video once in a forward pass")
+    parser.add_argument("--video_writer", type=str, choices=['ffmpeg','opencv'], default="ffmpeg", help="stream frames and audio into ffmpeg through pipes, or write temporary files with opencv and mux them")
+    parser.add_argument("--video_codec", type=str,   default="mpeg4",   help="ffmpeg video encoder used by the ffmpeg video writer. mpeg4 matches the opencv writer, libx264 is smaller but slower to encode")
+    parser.add_argument("--decode_gap", type=float,   default=3.0,   help="gap between segments (sec) decoded through instead of seeking over in sequential mode")
+    parser.add_argument("--frame_source", type=str, choices=['opencv','ffmpeg'], default="opencv", help="decode frames with cv2.VideoCapture, or with an ffmpeg process piping raw frames")
+    parser.add_argument("--decode_height", type=int,   default=0,   help="height source frames are scaled down to while decoding, before cropping. needs frame_source ffmpeg, source resolution if 0")
+    parser.add_argument("--decode_threads", type=int,   default=0,   help="decoding threads per worker, decoder default if 0")
 
     parser.set_defaults(use_vid_index=False)
     parser.set_defaults(no_wav=False)
@@ -0,0 +1,235 @@
+import os, glob, shutil, argparse, yaml, re, json, time, subprocess, platform
+import cv2
+import numpy as np
+
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from tools import segment_selector as ss
+from utils import common_utils as cu
+from utils import index_utils as iu
+from utils import script_utils as su
+from utils import synthetic_utils as sy
+from utils import transcript_utils as tu
+from utils import video_utils as vu
+from utils import wav_utils as wu
+
+_REPO_DIR = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+BENCHMARKS = ['metadata_load', 'segment_filter', 'script_generator', 'crop_wav', 'face_crop', 'face_track_write', 'extract_bbox', 'lab_generation']
+
+
+def git_revision():
+    # short hash of HEAD, marked dirty while tracked files have uncommitted changes
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=_REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=_REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+    return revision+'-dirty' if dirty else revision
+
+
+def load_preset(path):
+    # tool settings of a config file, lists joined with commas like cu.load_config
+    with open(path, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    return argparse.Namespace(**{k: ','.join(v) if isinstance(v, list) else v for k, v in config.items()})
+
+
+def load_fixture(args, minutes):
+    # synthetic dataset of a scale, generated once and reused by later runs with the same settings
+    name = f'{args.num_file}x{minutes:g}min_{args.width}x{args.height}_{args.fps}fps_{args.wav_sample_rate}hz_seed{args.seed}'
+    voxmm_dir = os.path.join(args.output_dir, 'fixtures', name)
+    # the file list is written last, so a fixture with a file list is complete
+    if not os.path.isfile(os.path.join(voxmm_dir, 'split', 'all.txt')):
+        print(f'Generating fixture {name}')
+        if os.path.isdir(voxmm_dir):
+            shutil.rmtree(voxmm_dir)
+        sy.make_dataset(voxmm_dir, args.num_file, minutes*60, args.fps, args.width, args.height, args.wav_sample_rate, seed=args.seed)
+    with open(os.path.join(voxmm_dir, 'split', 'all.txt'), 'r') as f:
+        file_list = [l.strip() for l in f if l.strip()]
+
+    return {'voxmm_dir': voxmm_dir, 'file_list': file_list, 'metadata': {fn: iu.load_metadata(voxmm_dir, fn) for fn in file_list}}
+
+
+def measure(run, repeat, setup=None):
+    # (items, best seconds, mean seconds) of run(state) over repeat runs, setup() prepares a fresh state outside the timing
+    times = []
+    for _ in range(repeat):
+        state = None if setup is None else setup()
+        begin = time.perf_counter()
+        items = run(state)
+        times.append(time.perf_counter()-begin)
+
+    return items, min(times), sum(times)/len(times)
+
+
+def benchmark(name, fixture, preset, args):
+    # (run, setup) of a benchmark on a fixture. run returns the number of items it processed.
+    voxmm_dir = fixture['voxmm_dir']
+    file_list = fixture['file_list']
+    segments = [(fn, seg) for fn in file_list for seg in fixture['metadata'][fn]['segments']]
+
+    if name=='metadata_load':
+        def run(state):
+            return sum([len(iu.load_metadata(voxmm_dir, fn)['segments']) for fn in file_list])
+        return run, None
+
+    elif name=='segment_filter':
+        columns = [iu.metadata_columns(fixture['metadata'][fn]) for fn in file_list]
+        def run(state):
+            return sum([len(ss.segment_reasons(cols, preset, noises)) for cols, speakers, noises in columns])
+        return run, None
+
+    elif name=='script_generator':
+        # transcripts are parsed and normalized from scratch in every run
+        def setup():
+            tu.lex.cache_clear()
+            return su.Script_Generator(**vars(preset))
+        def run(script_gen):
+            for fn, seg in segments:
+                script_gen(seg['text'])
+            return len(segments)
+        return run, setup
+
+    elif name=='crop_wav':
+        def setup():
+            return {fn: wu.Audio_Source(os.path.join(voxmm_dir, 'wav', fn+'.wav'), preset.sample_rate, preset.resampler, preset.resample_quality) for fn in file_list}
+        def run(sources):
+            for fn, seg in segments:
+                wu.crop_wav(sources[fn], seg['start'], seg['end'], preset.sample_rate, preset.volume)
+            return len(segments)
+        return run, setup
+
+    elif name in ['face_crop', 'face_track_write']:
+        # the first single face track segments. face_crop seeks every frame of a segment (decode_mode: seek) and counts frames
+        # after frame rate conversion, face_track_write decodes each video once and encodes the clips (decode_mode: sequential)
+        tracks = [(fn, seg['face_track'][0]['index'], seg['start'], seg['end']) for fn, seg in segments if len(seg['face_track'])==1][:args.video_segments]
+        clip_dir = os.path.join(args.output_dir, 'clips')
+        def setup():
+            shutil.rmtree(clip_dir, ignore_errors=True)
+            os.makedirs(clip_dir)
+            return {fn: vu.Face_Track_Generator(os.path.join(voxmm_dir, 'video', fn+'.mp4'), os.path.join(voxmm_dir, 'face_track', fn+'.json'), **vars(preset)) for fn in set([t[0] for t in tracks])}
+        if name=='face_crop':
+            def run(generators):
+                return sum([sum(1 for _ in generators[fn].get_face_crop(track_id, start, end)) for fn, track_id, start, end in tracks])
+        else:
+            def run(generators):
+                written = 0
+                for fn, generator in generators.items():
+                    windows = [(i, track_id, start, end, os.path.join(clip_dir, f'{i}.mp4')) for i, (f, track_id, start, end) in enumerate(tracks) if f==fn]
+                    for i, error in generator.write_face_tracks(windows, int(preset.decode_gap*generator.fps), preset.volume):
+                        if not error is None:
+                            raise Exception(f"face track writing failed. {error}")
+                        written += 1
+                return written
+        return run, setup
+
+    elif name=='extract_bbox':
+        face_tracks = {}
+        for fn in file_list:
+            with open(os.path.join(voxmm_dir, 'face_track', fn+'.json'), 'r') as f:
+                face_tracks[fn] = cu.parse_face_track_json(json.load(f))
+        tracks = [(fn, track['index'], seg['start'], seg['end']) for fn, seg in segments for track in seg['face_track']]
+        def run(state):
+            for fn, track_id, start, end in tracks:
+                cu.extract_bbox([start, end], face_tracks[fn][track_id])
+            return len(tracks)
+        return run, None
+
+    elif name=='lab_generation':
+        # oracle vad of diarisation_preprocessor: merged speech, overlapped duration and lab lines
+        intervals = [sorted([[seg['start'], seg['end']] for seg in fixture['metadata'][fn]['segments']]) for fn in file_list]
+        def run(state):
+            for rttm in intervals:
+                cu.oracle_vad(rttm)
+            return sum([len(rttm) for rttm in intervals])
+        return run, None
+
+    else:
+        raise Exception(f"Invalid benchmark: {name}")
+
+
+def load_baseline(args, revision):
+    # results of the baseline revision (or path), the latest results of another revision if not given
+    results_dir = os.path.join(args.output_dir, 'results')
+    if args.baseline:
+        path = args.baseline if os.path.isfile(args.baseline) else os.path.join(results_dir, args.baseline+'.json')
+        if not os.path.isfile(path):
+            raise Exception(f"Cannot find baseline results: {args.baseline}")
+    else:
+        paths = sorted([p for p in glob.glob(os.path.join(results_dir, '*.json')) if os.path.basename(p)!=revision+'.json'], key=os.path.getmtime)
+        if len(paths)==0:
+            return None
+        path = paths[-1]
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def benchmark_runner(args):
+    preset = load_preset(args.preset)
+    names = BENCHMARKS if not args.benchmarks else [name.strip() for name in args.benchmarks.replace('[','').replace(']','').split(',')]
+    for name in names:
+        if not name in BENCHMARKS:
+            raise Exception(f"Invalid benchmark: {name}")
+    revision = git_revision()
+    baseline = load_baseline(args, revision)
+    baseline_results = {} if baseline is None else {(r['benchmark'], r['scale']): r for r in baseline['results']}
+
+    scales = [float(s) for s in args.scales.replace('[','').replace(']','').split(',')]
+    fixtures = [load_fixture(args, minutes) for minutes in scales]
+
+    results = []
+    print(f'Benchmark of revision {revision}' + ('' if baseline is None else f", compared with {baseline['revision']}"))
+    print('{:<18}{:>8}{:>9}{:>11}{:>14}{:>10}'.format('benchmark', 'minutes', 'items', 'best (s)', 'per item (us)', 'change'))
+    for minutes, fixture in zip(scales, fixtures):
+        for name in names:
+            run, setup = benchmark(name, fixture, preset, args)
+            items, best, mean = measure(run, args.repeat, setup)
+            result = {'benchmark': name, 'scale': minutes, 'files': len(fixture['file_list']), 'items': items, 'best': best, 'mean': mean, 'per_item': best/max(items,1)}
+            results.append(result)
+            change = ''
+            if (name, minutes) in baseline_results:
+                change = '{:+.1f}%'.format((best/max(baseline_results[(name, minutes)]['best'],1e-12)-1)*100)
+            print('{:<18}{:>8g}{:>9}{:>11.4f}{:>14.2f}{:>10}'.format(name, minutes, items, best, result['per_item']*1e6, change))
+
+    os.makedirs(os.path.join(args.output_dir, 'results'), exist_ok=True)
+    output_path = os.path.join(args.output_dir, 'results', revision+'.json')
+    with open(output_path, 'w') as f:
+        json.dump({
+            'revision': revision,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'settings': vars(args),
+            'results': results,
+        }, f, indent=2)
+    print(f'Results saved to {output_path}')
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description = "Preprocessing Benchmark")
+
+    parser.add_argument("--config", type=str,   default=None,   help="config YAML file")
+    parser.add_argument("--output_dir", type=str,   default="./VoxMM_benchmark",   help="path for generated fixtures and benchmark results")
+    parser.add_argument("--preset", type=str,   default="./configs/AV-ASR.yaml",   help="config whose selection, script, wav and video settings are benchmarked")
+    parser.add_argument("--benchmarks", type=str,   default="",   help="benchmarks to run, all if empty: "+', '.join(BENCHMARKS))
+    parser.add_argument("--baseline", type=str,   default="",   help="revision or results file to compare with, the latest results of another revision if empty")
+    parser.add_argument("--repeat", type=int,   default=3,   help="runs per benchmark, the best one is reported")
+
+    # synthetic fixtures
+    parser.add_argument("--scales", type=str,   default="1, 5, 20",   help="recording length of the synthetic files in minutes, one fixture per scale")
+    parser.add_argument("--num_file", type=int,   default=2,   help="synthetic files per scale")
+    parser.add_argument("--video_segments", type=int,   default=20,   help="maximum number of segments cropped by the face_crop and face_track_write benchmarks")
+    parser.add_argument("--width", type=int,   default=320,   help="width of the synthetic videos")
+    parser.add_argument("--height", type=int,   default=240,   help="height of the synthetic videos")
+    parser.add_argument("--fps", type=int,   default=25,   help="frame rate of the synthetic videos")
+    parser.add_argument("--wav_sample_rate", type=int,   default=16000,   help="sample rate of the synthetic wav files, resampled when it differs from the preset sample_rate")
+    parser.add_argument("--seed", type=int,   default=0,   help="random seed of the synthetic fixtures")
+
+    args = cu.load_config(parser)
+
+    benchmark_runner(args)
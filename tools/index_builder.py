@@ -0,0 +1,57 @@
+import os, glob, shutil, argparse, yaml, re, json
+from tqdm import tqdm
+
+from multiprocessing import Pool
+
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from utils import common_utils as cu
+from utils import index_utils as iu
+
+
+def load_metadata(buff):
+    # the JSON is stat'ed before parsing, so a change while indexing still marks the index out of date
+    stat = iu.source_stat(buff['voxmm_dir'], buff['fn'])
+
+    return iu.load_metadata(buff['voxmm_dir'], buff['fn']), stat
+
+
+def index_builder(args):
+    if args.file_list_paths:
+        file_list = []
+        for file_list_path in args.file_list_paths.replace('[','').replace(']','').split(','):
+            with open(file_list_path.strip(), 'r') as f:
+                for l in f.readlines():
+                    if l.strip() and not l.strip() in file_list:
+                        file_list.append(l.strip())
+    else:
+        file_list = sorted([os.path.splitext(os.path.basename(path))[0] for path in glob.glob(os.path.join(args.voxmm_dir,'metadata','*.json'))])
+    index_dir = args.metadata_index if args.metadata_index else os.path.join(args.voxmm_dir,'index')
+
+    print(f'Building metadata index of {len(file_list)} files')
+    buff = [{"voxmm_dir": args.voxmm_dir, "fn": fn} for fn in file_list]
+    p = Pool(args.num_worker)
+    # imap keeps the file order, metadata are parsed in the workers and indexed in this process
+    header = iu.build_index(tqdm(p.imap(load_metadata, buff, max(1, len(buff)//(args.num_worker*8))), total=len(buff)), index_dir)
+    p.close()
+    p.join()
+
+    print(f'- files: {len(header["file_names"])}')
+    print(f'- speakers: {len(header["speakers"])}')
+    print(f'Metadata index saved to {index_dir}')
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description = "Metadata Index Builder")
+
+    parser.add_argument("--config", type=str,   default=None,   help="config YAML file")
+    parser.add_argument("--num_worker", type=int,   default=1,   help="number of process")
+
+    parser.add_argument("--voxmm_dir", type=str,   default="./VoxMM",   help="VoxMM dataset")
+    parser.add_argument("--file_list_paths", type=str,   default="",   help="file lists to index, every metadata file is indexed if empty")
+    parser.add_argument("--metadata_index", type=str,   default="",   help="output directory of the metadata index, VOXMM_DIR/index if empty")
+
+    args = cu.load_config(parser)
+
+    index_builder(args)
@@ -1,112 +1,96 @@
-import os, glob, shutil, argparse, yaml, re, json
+import os, glob, shutil, argparse, yaml, re, json, time
+import numpy as np
 from tqdm import tqdm
 
+from multiprocessing import Pool
+
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 
 from utils import common_utils as cu
+from utils import index_utils as iu
+from utils import profile_utils as pu
+from utils import selection_utils as sl
+from utils import transcript_utils as tu
+
+def script_filter(tokens, args):
+    # returns None if the transcript passes, otherwise the reason it is excluded
+    word_cnt = 0
+    for typ, start, end, words in tokens.tolist():
+        if typ==tu.INAUDIBLE and args.no_inaudible:
+            return 'inaudible'
+
+        elif typ==tu.UNCERTAIN:
+            if args.no_uncertain:
+                return 'uncertain'
+            if args.count_uncertain_as_word:
+                word_cnt += words
+
+        elif typ==tu.INTERJECTION:
+            if args.no_interjection:
+                return 'interjection'
+            if args.count_interjection_as_word:
+                word_cnt += words
+
+        elif typ==tu.DIFFLUENCY:
+            if args.no_diffluency:
+                return 'diffluency'
+            if args.count_diffluency_as_word:
+                word_cnt += words
+
+        elif typ==tu.MASKED:
+            return 'asterisk'
+
+        else: # normal word, abbreviation or numeric
+            word_cnt += words
+
+    if word_cnt>=args.max_word or word_cnt<=args.min_word:
+        return 'word count'
+
+    return None
+
+
+def segment_reasons(cols, args, noises):
+    # exclusion reason of every segment of a file, '' for the selected ones
+    with pu.stage('segment filter'):
+        reasons = sl.filter_segments(cols, args, noises)
+    # script filter only on the segments passing the other filters
+    if args.script_filter:
+        with pu.stage('script filter'):
+            offsets = cols['token_offsets']
+            for j in np.flatnonzero(reasons=='').tolist():
+                reason = script_filter(cols['tokens'][offsets[j]:offsets[j+1]], args)
+                if reason is not None:
+                    reasons[j] = reason
 
-PATTERN = r'![^!]*!|\{[^}]*\}|\([^/][^)]*\)|\[[^\]]*\]|<[^>]*>|\w+'
-
-def segment_filter(segment, args):
-    global sing, overlap, onscreen, inaud, uncert, interj, diff, durr, wcnt, m_onscreen, p_onscreen
-
-    txt = segment['text']
-    duration = segment['end'] - segment['start']
-
-    ###### common filter
-    if duration>=args.max_duration or duration<=args.min_duration:
-        durr += duration
-        return False
-
-    elif segment['singing'] and args.no_singing:
-        sing += duration
-        return False
-
-    elif segment['overlapped_duration']>0 and args.no_overlap:
-        overlap += duration
-        return False
-
-
-    # on-screen filter
-    if segment['on-screen']:
-        if len(segment['face_track'])!=1 and args.no_multiple_on_screen:
-            m_onscreen += duration
-            return False
+    return reasons
 
-        for track in segment['face_track']:
-            if (track['timestamp'][0]-segment['start']>0.01 or segment['end']-track['timestamp'][1]>0.01) and args.no_partially_on_screen:
-               p_onscreen += duration
-               return False
 
-    else:
-        if args.only_on_screen:
-            onscreen += duration
-            return False
+def select_segments(buff):
+    args = buff['args']
+    fn = buff['fn']
+    with pu.Task():
+        with pu.stage('metadata load'):
+            info, cols, speakers, noises = iu.load_columns(args.voxmm_dir, fn, args.metadata_index)
 
-    # background noise 
-    if segment['background_noise']!='N/A':
-        filtered_noise_list = [n for n in segment['background_noise'].keys() if n in args.background_noise_list]
-        if len(filtered_noise_list)>0 and args.no_overlap:
-            return False
+        reasons = segment_reasons(cols, args, noises)
+        with pu.stage('statistics'):
+            stats = sl.Selection_Statistics()
+            stats.add_file(info)
+            stats.add_segments(cols, reasons, speakers)
+        selected = np.asarray(cols['segment_index'])[reasons==''].tolist()
+        pu.count('segments', len(reasons))
 
-    ###### script filter
-    if args.script_filter:
-        splitted_txt = re.findall(PATTERN, txt)
-        word_cnt = 0
-        for inst in splitted_txt:
-            if inst=='(inaudible)' and args.no_inaudible: # inaudible 
-                #print("inaudible: ",txt)
-                inaud += duration
-                return False
-
-            elif "[" in inst:  # uncertain
-                if args.no_uncertain:
-                    #print("uncertain: ",txt)
-                    uncert += duration
-                    return False
-                if args.count_uncertain_as_word:
-                    word_cnt += len(inst.replace("[","").replace("]","").split())
-
-            elif "{" in inst:  # interjection
-                if args.no_interjection:
-                    #print("interj: ",txt)
-                    interj += duration
-                    return False
-                if args.count_interjection_as_word:
-                    word_cnt += len(inst.replace("{","").replace("}","").split())
-
-            elif "<" in inst:  # diffluency
-                if args.no_diffluency:
-                    #print("diffluency: ",txt)
-                    diff += duration
-                    return False
-                if args.count_diffluency_as_word:
-                    word_cnt += len(inst.replace("<","").replace(">","").split())
-
-            elif "(" in inst and "/" in inst:  # numeric
-                word_cnt += len(inst.replace("(","").replace(")","").split("/")[-1].split())
-
-            elif "*" in inst:
-                return False
-
-            else: # normal word or abbreviation
-                word_cnt += 1
-
-        if word_cnt>=args.max_word or word_cnt<=args.min_word:
-            #print("word cnt: ",txt)
-            wcnt += duration
-            return False
-
-    return True
+    return fn, selected, stats, pu.collect()
 
 
 def segment_selection(args):
-    global sing, overlap, onscreen, inaud, uncert, interj, diff, durr, wcnt, m_onscreen, p_onscreen
-
     output_dir = os.path.join(args.output_dir,'segment_list')
     os.makedirs(output_dir, exist_ok=True)
     
+    begin = time.time()
+    profiler = pu.Profiler()
+    p = Pool(args.num_worker, initializer=pu.enable, initargs=(args.profile, pu.profile_dir(args), 'segment_selector'))
     file_list_paths = args.file_list_paths.replace('[','').replace(']','').split(',')
     for file_list_path in file_list_paths:
         file_list_path = file_list_path.strip()
@@ -115,71 +99,24 @@ def segment_selection(args):
             for l in f.readlines():
                 file_list.append(l.strip())
 
-        selected_cnt = 0
-        selected_duration = 0
-        selected_onscreen_duration = 0
-        selected_spk = []
-
-        total_duration = 0
-        total_onscreen_duration = 0
-        total_cnt = 0
-        total_spk = []
-
+        buff = [{"args": args, "fn": fn} for fn in file_list]
+        chunksize = max(1, len(buff)//(args.num_worker*8))
+        total = sl.Selection_Statistics()
         with open(os.path.join(output_dir,os.path.basename(file_list_path)),"w") as f:
-            for fn in tqdm(file_list):
-                metadata_path = os.path.join(args.voxmm_dir,'metadata',fn+'.json')
-
-                local_cnt = 0
-                local_dur = 0
-                
-                with open(metadata_path, 'r') as fm:
-                    metadata = json.load(fm)
-                    cu.version_check(metadata['metadata_version'])
-
-                for seg in metadata['segments']:
-                    if not seg['speaker_id'] in total_spk:
-                        total_spk.append(seg['speaker_id'])
-                    if segment_filter(seg,args):
-                        f.write('{} {} \n'.format(fn, seg['segment_index']))
-                        selected_cnt += 1
-                        selected_duration += seg['end']-seg['start']
-                        if seg['on-screen']:
-                            selected_onscreen_duration += seg['end']-seg['start']
-
-                        if not seg['speaker_id'] in selected_spk:
-                            selected_spk.append(seg['speaker_id'])
-
-
-                total_duration += metadata['statistics']['utterance_duration']
-                total_onscreen_duration += metadata['statistics']['on-screen_duration']
-                total_cnt += metadata['statistics']['segment_num']
-
-
-        print(f'\nResults for {file_list_path}')
-        print(f'\nTotal segments in file list ({file_list_path})') 
-        print(f'- total segment num: {total_cnt}')
-        print(f'- total segment duration: {total_duration/3600:.2f} hrs')
-        print(f'- total speaker: {len(total_spk)}')
-
-        print('\nSelected Segments') 
-        print(f'- total segment num: {selected_cnt}')
-        print(f'- total segment duration: {selected_duration/3600:.2f} hrs')
-        print(f'- total speaker: {len(selected_spk)}')
-
-        print('\nExcluded Segments') 
-        print(f'- singing: {sing/60:.2f} mins')
-        print(f'- overlap: {overlap/60:.2f} mins')
-        print(f'- off-screen: {onscreen/60:.2f} mins')
-        print(f'- partially on-screen: {p_onscreen/60:.2f} mins')
-        print(f'- scene changed on-screen: {m_onscreen/60:.2f} mins')
-        print(f'- inaudible: {inaud/60:.2f} mins')
-        print(f'- uncertain: {uncert/60:.2f} mins')
-        print(f'- interjection: {interj/60:.2f} mins')
-        print(f'- diffluency: {diff/60:.2f} mins')
-        print(f'- duration: {durr/60:.2f} mins')
-        print(f'- word count: {wcnt/60:.2f} mins')
-        print('\n','='*20)
-
+            # imap keeps the file order of the list in the written segment list
+            for fn, selected, stats, profile in tqdm(p.imap(select_segments, buff, chunksize), total=len(buff)):
+                for seg_idx in selected:
+                    f.write('{} {} \n'.format(fn, seg_idx))
+                total += stats
+                profiler += profile
+
+        total.print_summary(file_list_path)
+        total.save_json(os.path.join(output_dir,os.path.splitext(os.path.basename(file_list_path))[0]+'.stats.json'))
+
+    p.close()
+    p.join()
+    if args.profile!='none':
+        pu.report(profiler, pu.profile_dir(args), 'segment_selector', time.time()-begin, args.num_worker)
     print("Segment Selection Done")
 
 
@@ -187,9 +124,13 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser(description = "Segment Selector")
 
     parser.add_argument("--config", type=str,   default=None,   help="config YAML file")
+    parser.add_argument("--num_worker", type=int,   default=1,   help="number of process")
+    parser.add_argument("--profile", type=str, choices=['none','stages','cprofile'], default="none", help="time the processing stages across workers, cprofile also dumps function statistics per worker")
+    parser.add_argument("--profile_dir", type=str,   default="",   help="directory of the profile report and dumps, OUTPUT_DIR/profile if empty")
     
     parser.add_argument("--voxmm_dir", type=str,   default="./VoxMM",   help="VoxMM dataset")
     parser.add_argument("--file_list_paths", type=str,   default="VoxMM/split/test.txt, VoxMM/split/train.txt",   help="file list to preprocess")
+    parser.add_argument("--metadata_index", type=str,   default="",   help="metadata index built by index_builder, read instead of the metadata JSON files")
     parser.add_argument("--output_dir", type=str,   default="./result",   help="path for preprocessed results")
 
     # common filter
@@ -232,19 +173,6 @@ if __name__=="__main__":
 
     args = cu.load_config(parser)
 
-    sing = 0
-    overlap = 0
-    onscreen = 0
-    inaud = 0
-    uncert = 0
-    interj = 0
-    diff = 0
-    durr = 0
-    wcnt = 0
-    m_onscreen = 0
-    p_onscreen = 0
-
     # segment selection
     segment_selection(args)
     
-
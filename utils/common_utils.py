@@ -1,4 +1,5 @@
 import os, glob, shutil, argparse, yaml, re, json
+import numpy as np
 
 VERSION = "1.0.x"
 
@@ -13,19 +14,61 @@ def check_overlap(timeline, timestamp_list):
         
     return False
 
+def merge_intervals(intervals):
+    # union of [start, end] intervals in O(n log n). intervals that only touch are kept apart.
+    merged = []
+    for start, end in sorted(intervals):
+        if len(merged)>0 and start<merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return merged
+
+
+def sweep_intervals(intervals):
+    # yields (start, end, depth) for every stretch between interval boundaries covered by depth>0 intervals
+    events = sorted([(start, 1) for start, end in intervals] + [(end, -1) for start, end in intervals])
+    depth = 0
+    prev = None
+    for timeline, delta in events:
+        if depth>0 and timeline>prev:
+            yield prev, timeline, depth
+        depth += delta
+        prev = timeline
+
+
+def overlapped_duration(intervals, min_depth=2):
+    # total duration covered by at least min_depth intervals at the same time
+    return sum(end-start for start, end, depth in sweep_intervals(intervals) if depth>=min_depth)
+
+def oracle_vad(intervals):
+    # (lab file text, speech duration, overlapped duration) of the oracle vad over [start, end] speech intervals
+    lab_list = merge_intervals(intervals)
+    lab = ''.join(['{:.6f} {:.6f} speech\n'.format(start, end) for start, end in lab_list])
+
+    return lab, sum(end-start for start, end in lab_list), overlapped_duration(intervals)
+
+
 def bbox_only_in_screen(bbox):
+    if isinstance(bbox, np.ndarray):
+        # (N,4) bboxes at once
+        return np.concatenate([np.maximum(bbox[...,:2],0.0), np.minimum(bbox[...,2:],1.0)], axis=-1)
+
     return [max(bbox[0],0.0), max(bbox[1],0.0), min(bbox[2],1.0), min(bbox[3],1.0)]
 
 
 
 def extract_bbox(timestamp, entities, no_out_screen=True):
-    idxs = [i for i in range(len(entities['time_stamp'])) if entities['time_stamp'][i]>=timestamp[0] and entities['time_stamp'][i]<=timestamp[1]]
+    # entities: a face track with time_stamp sorted in ascending order, preferably parsed by parse_face_track_json
+    time_stamp = np.asarray(entities['time_stamp'])
+    first = np.searchsorted(time_stamp, timestamp[0], side='left')
+    last = np.searchsorted(time_stamp, timestamp[1], side='right')
+    bbox = np.asarray(entities['bbox'][first:last], dtype=np.float64).reshape(-1,4)
     if no_out_screen:
-        result = [[entities['time_stamp'][i],bbox_only_in_screen(entities['bbox'][i])] for i in idxs]
-    else:
-        result = [[entities['time_stamp'][i],entities['bbox'][i]] for i in idxs]
+        bbox = bbox_only_in_screen(bbox)
 
-    return result
+    return [list(r) for r in zip(time_stamp[first:last].tolist(), bbox.tolist())]
 
 def load_segment_list(segment_list_path):
     segment_dict = {}
@@ -41,6 +84,29 @@ def load_segment_list(segment_list_path):
     return segment_dict
         
 
+def iter_segment_list(segment_list_path):
+    # yields (file name, segment indices) while reading the segment list, whose lines are grouped by file
+    seen = set()
+    fn = None
+    seg_idxs = []
+    with open(segment_list_path,'r') as f:
+        for segment in f:
+            if len(segment.split())<2:
+                continue
+            seg_fn = segment.split()[0].strip()
+            if seg_fn!=fn:
+                if not fn is None:
+                    yield fn, seg_idxs
+                if seg_fn in seen:
+                    raise Exception(f"segment list is not grouped by file: {seg_fn} in {segment_list_path}. group its lines by file to read it as a stream")
+                seen.add(seg_fn)
+                fn = seg_fn
+                seg_idxs = []
+            seg_idxs.append(int(segment.split()[1].strip()))
+    if not fn is None:
+        yield fn, seg_idxs
+
+
 def find_option_type(key, parser):
     for opt in parser._get_optional_actions():
         if ('--' + key) in opt.option_strings:
@@ -92,31 +158,43 @@ def output_destination(filename, segment, output_dir, style='librispeech'):
 
 
 def parse_face_track_json(face_track_json):
+    # face tracks as arrays per track index: frame (N,), bbox (N,4) and time_stamp (N,), sorted by frame
     parsed_face_track = {}
     for tr in face_track_json['face_tracks']:
-        tidx = tr['track_index']
-        parsed_face_track[tidx] = {}
-        for i, f in enumerate(tr['frame']):
-            parsed_face_track[tidx][f] = tr['bbox'][i]
+        frame = np.asarray(tr['frame'], dtype=np.int64)
+        track = {'frame': frame, 'bbox': np.asarray(tr['bbox'], dtype=np.float64).reshape(-1,4)}
+        if 'time_stamp' in tr:
+            track['time_stamp'] = np.asarray(tr['time_stamp'], dtype=np.float64)
+        if np.any(np.diff(frame)<0):
+            order = np.argsort(frame, kind='stable')
+            track = {k: v[order] for k, v in track.items()}
+        parsed_face_track[tr['track_index']] = track
     
     return parsed_face_track
 
 
+def face_track_bbox(face_track, idx):
+    # bbox of frame idx (int or array), clamped to the first and last frame of the track
+    frame = face_track['frame']
+    idx = np.clip(idx, frame[0], frame[-1])
+    if frame[-1]-frame[0]+1==len(frame):
+        return face_track['bbox'][idx-frame[0]]
+
+    # frames missing in the track take the bbox of the previous detected frame
+    return face_track['bbox'][np.searchsorted(frame, idx, side='right')-1]
+
+
 def resample_face_track(face_track_json, trg_fps):
     parsed_face_track = parse_face_track_json(face_track_json)
     json_fps = face_track_json['FPS']
     face_track_json['FPS'] = trg_fps
     new_face_tracks = []
-    for tr in face_track_json['face_tracks']:
-        tidx = tr['track_index']
+    for tidx, tr in parsed_face_track.items():
         start_f = tr['frame'][0]
         end_f = tr['frame'][-1]
-        face_tracks = {'track_index':tidx, 'frame':[],'bbox':[],'time_stamp':[]}
-        for f in range(int(start_f*trg_fps/json_fps),int(end_f*trg_fps/json_fps)):
-            face_tracks['frame'].append(f)
-            face_tracks['bbox'].append(parsed_face_track[tidx][min(max(int(f*json_fps/trg_fps),start_f),end_f)])
-            face_tracks['time_stamp'].append(f/trg_fps)
-        new_face_tracks.append(face_tracks)
+        frame = np.arange(int(start_f*trg_fps/json_fps),int(end_f*trg_fps/json_fps))
+        src_frame = (frame*json_fps/trg_fps).astype(np.int64)
+        new_face_tracks.append({'track_index': tidx, 'frame': frame, 'bbox': face_track_bbox(tr, src_frame), 'time_stamp': frame/trg_fps})
     face_track_json['face_tracks'] = new_face_tracks
             
     return face_track_json
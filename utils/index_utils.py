@@ -0,0 +1,295 @@
+import os, json
+from functools import lru_cache
+import numpy as np
+
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from utils import common_utils as cu
+from utils import transcript_utils as tu
+
+INDEX_VERSION = 2
+HEADER_NAME = 'index.json'
+
+# per file columns, indexed by file position
+FILE_COLUMNS = ['file_offsets', 'file_index', 'utterance_duration', 'onscreen_duration', 'segment_num']
+# per segment columns, indexed by segment row. *_offsets columns delimit the ragged columns that follow them.
+SEGMENT_COLUMNS = ['segment_index', 'start', 'end', 'speaker', 'singing', 'overlapped_duration', 'on_screen', 'noise_info',
+                   'face_track_offsets', 'face_track_index', 'face_track_start', 'face_track_end',
+                   'noise_offsets', 'noise_code',
+                   'text_offsets', 'text',
+                   'token_offsets', 'tokens']
+
+
+def ragged(lists, dtype):
+    offsets = np.zeros(len(lists)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    values = np.array([v for l in lists for v in l], dtype=dtype)
+
+    return offsets, values
+
+
+def source_stat(voxmm_dir, fn):
+    # [size, mtime in ns] of the metadata JSON of a file, None if it does not exist
+    try:
+        stat = os.stat(os.path.join(voxmm_dir,'metadata',fn+'.json'))
+    except FileNotFoundError:
+        return None
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def build_index(metadata_list, index_dir):
+    # metadata_list: iterable of (parsed metadata JSON, source_stat of the JSON taken before parsing), stored in the given order
+    os.makedirs(index_dir, exist_ok=True)
+    header = {'index_version': INDEX_VERSION, 'file_names': [], 'metadata_versions': [], 'source_stats': [], 'speakers': [], 'background_noises': []}
+    speakers = {}
+    noises = {}
+    files = {k: [] for k in FILE_COLUMNS if k!='file_offsets'}
+    segments = {k: [] for k in ['segment_index', 'start', 'end', 'speaker', 'singing', 'overlapped_duration', 'on_screen', 'noise_info']}
+    face_tracks = []
+    noise_codes = []
+    texts = []
+    tokens = []
+    seg_cnt = [0]
+    for metadata, stat in metadata_list:
+        header['file_names'].append(metadata['video_infos']['file_name'])
+        header['source_stats'].append(stat)
+        header['metadata_versions'].append(metadata['metadata_version'])
+        files['file_index'].append(metadata['video_infos']['index'])
+        files['utterance_duration'].append(metadata['statistics']['utterance_duration'])
+        files['onscreen_duration'].append(metadata['statistics']['on-screen_duration'])
+        files['segment_num'].append(metadata['statistics']['segment_num'])
+        for seg in metadata['segments']:
+            segments['segment_index'].append(seg['segment_index'])
+            segments['start'].append(seg['start'])
+            segments['end'].append(seg['end'])
+            segments['speaker'].append(speakers.setdefault(seg['speaker_id'], len(speakers)))
+            segments['singing'].append(bool(seg['singing']))
+            segments['overlapped_duration'].append(seg['overlapped_duration'])
+            segments['on_screen'].append(bool(seg['on-screen']))
+            segments['noise_info'].append(seg['background_noise']!='N/A')
+            face_tracks.append([(track['index'], track['timestamp'][0], track['timestamp'][1]) for track in seg['face_track']])
+            noise_codes.append([] if seg['background_noise']=='N/A' else [noises.setdefault(n, len(noises)) for n in seg['background_noise'].keys()])
+            texts.append(seg['text'].encode('utf-8'))
+            tokens.append(tu.lex(seg['text']))
+        seg_cnt.append(seg_cnt[-1]+len(metadata['segments']))
+    header['speakers'] = list(speakers.keys())
+    header['background_noises'] = list(noises.keys())
+
+    columns = {'file_offsets': np.array(seg_cnt, dtype=np.int64),
+               'file_index': np.array(files['file_index'], dtype=np.int64),
+               'utterance_duration': np.array(files['utterance_duration'], dtype=np.float64),
+               'onscreen_duration': np.array(files['onscreen_duration'], dtype=np.float64),
+               'segment_num': np.array(files['segment_num'], dtype=np.int64),
+               'segment_index': np.array(segments['segment_index'], dtype=np.int64),
+               'start': np.array(segments['start'], dtype=np.float64),
+               'end': np.array(segments['end'], dtype=np.float64),
+               'speaker': np.array(segments['speaker'], dtype=np.int32),
+               'singing': np.array(segments['singing'], dtype=bool),
+               'overlapped_duration': np.array(segments['overlapped_duration'], dtype=np.float64),
+               'on_screen': np.array(segments['on_screen'], dtype=bool),
+               'noise_info': np.array(segments['noise_info'], dtype=bool)}
+    columns['face_track_offsets'], face_track_values = ragged(face_tracks, np.float64)
+    face_track_values = face_track_values.reshape(-1,3)
+    columns['face_track_index'] = face_track_values[:,0].astype(np.int64)
+    columns['face_track_start'] = face_track_values[:,1]
+    columns['face_track_end'] = face_track_values[:,2]
+    columns['noise_offsets'], columns['noise_code'] = ragged(noise_codes, np.int32)
+    columns['text_offsets'], columns['text'] = ragged(texts, np.uint8)
+    columns['token_offsets'] = np.zeros(len(tokens)+1, dtype=np.int64)
+    columns['token_offsets'][1:] = np.cumsum([len(t) for t in tokens])
+    columns['tokens'] = np.concatenate(tokens+[np.zeros((0,4), dtype=np.int32)]).astype(np.int32)
+
+    # the old header is removed before any column changes and the new one is written last,
+    # so a half written index is never picked up
+    header_path = os.path.join(index_dir, HEADER_NAME)
+    if os.path.isfile(header_path):
+        os.remove(header_path)
+    for k, v in columns.items():
+        # columns are replaced rather than overwritten, processes mapping the old ones keep reading them
+        np.save(os.path.join(index_dir, k+'.tmp.npy'), v)
+        os.replace(os.path.join(index_dir, k+'.tmp.npy'), os.path.join(index_dir, k+'.npy'))
+    tmp_path = os.path.join(index_dir, HEADER_NAME+'.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(header, f)
+    os.replace(tmp_path, header_path)
+
+    return header
+
+
+class Metadata_Index():
+    # columnar view of VoxMM metadata built by build_index. columns are memory-mapped on first use.
+    def __init__(self, index_dir):
+        header_path = os.path.join(index_dir, HEADER_NAME)
+        if not os.path.isfile(header_path):
+            raise Exception(f"Metadata index not found: {index_dir}")
+        with open(header_path, 'r') as f:
+            self.header = json.load(f)
+        if self.header['index_version']!=INDEX_VERSION:
+            raise Exception(f"Metadata index version {self.header['index_version']} is not supported, rebuild the index: {index_dir}")
+
+        self.index_dir = index_dir
+        self.file_names = self.header['file_names']
+        self.file_pos = {fn: i for i, fn in enumerate(self.file_names)}
+        self.speakers = self.header['speakers']
+        self.noises = self.header['background_noises']
+        self.noise_codes = {n: i for i, n in enumerate(self.noises)}
+        self.cols = {}
+        self.checked = set()
+
+    def __contains__(self, fn):
+        return fn in self.file_pos
+
+    def __getitem__(self, column):
+        if not column in self.cols:
+            self.cols[column] = np.load(os.path.join(self.index_dir, column+'.npy'), mmap_mode='r')
+
+        return self.cols[column]
+
+    def file_position(self, fn):
+        if not fn in self.file_pos:
+            raise Exception(f"{fn} not found in metadata index {self.index_dir}")
+
+        return self.file_pos[fn]
+
+    def check_source(self, voxmm_dir, fn):
+        # a file whose metadata JSON changed after the index was built is refused. checked once per file and process,
+        # and skipped when the JSON is not there
+        if fn in self.checked:
+            return
+        stat = source_stat(voxmm_dir, fn)
+        if not stat is None and stat!=self.header['source_stats'][self.file_position(fn)]:
+            raise Exception(f"Metadata index is out of date for {fn}, rebuild the index: {self.index_dir}")
+        self.checked.add(fn)
+
+    def file_rows(self, fn):
+        i = self.file_position(fn)
+
+        return int(self['file_offsets'][i]), int(self['file_offsets'][i+1])
+
+    def columns(self, fn):
+        # segment columns of a file, sliced without copying. ragged columns come with offsets starting at 0.
+        first, last = self.file_rows(fn)
+        cols = {k: self[k][first:last] for k in ['segment_index', 'start', 'end', 'speaker', 'singing', 'overlapped_duration', 'on_screen', 'noise_info']}
+        for offsets_col, value_cols in [('face_track_offsets', ['face_track_index', 'face_track_start', 'face_track_end']),
+                                        ('noise_offsets', ['noise_code']),
+                                        ('token_offsets', ['tokens'])]:
+            offsets = np.asarray(self[offsets_col][first:last+1])
+            cols[offsets_col] = offsets-offsets[0]
+            for k in value_cols:
+                cols[k] = self[k][offsets[0]:offsets[-1]]
+
+        return cols
+
+    def text(self, row):
+        first, last = self['text_offsets'][row], self['text_offsets'][row+1]
+
+        return bytes(self['text'][first:last]).decode('utf-8')
+
+    def file_info(self, fn):
+        # metadata of a file without its segments
+        i = self.file_position(fn)
+
+        return {
+            'metadata_version': self.header['metadata_versions'][i],
+            'video_infos': {'file_name': fn, 'index': int(self['file_index'][i])},
+            'statistics': {'utterance_duration': float(self['utterance_duration'][i]),
+                           'on-screen_duration': float(self['onscreen_duration'][i]),
+                           'segment_num': int(self['segment_num'][i])},
+        }
+
+    def metadata(self, fn):
+        # metadata of a file shaped like its JSON, limited to the fields the preprocessors read
+        first, last = self.file_rows(fn)
+        cols = self.columns(fn)
+        segments = []
+        for j, row in enumerate(range(first, last)):
+            ft_first, ft_last = cols['face_track_offsets'][j], cols['face_track_offsets'][j+1]
+            noise_first, noise_last = cols['noise_offsets'][j], cols['noise_offsets'][j+1]
+            tok_first, tok_last = cols['token_offsets'][j], cols['token_offsets'][j+1]
+            segments.append({
+                'segment_index': int(cols['segment_index'][j]),
+                'start': float(cols['start'][j]),
+                'end': float(cols['end'][j]),
+                'speaker_id': self.speakers[cols['speaker'][j]],
+                'text': self.text(row),
+                'singing': bool(cols['singing'][j]),
+                'overlapped_duration': float(cols['overlapped_duration'][j]),
+                'on-screen': bool(cols['on_screen'][j]),
+                'face_track': [{'index': int(cols['face_track_index'][k]), 'timestamp': [float(cols['face_track_start'][k]), float(cols['face_track_end'][k])]} for k in range(ft_first, ft_last)],
+                # only the noise categories are indexed
+                'background_noise': {self.noises[c]: None for c in cols['noise_code'][noise_first:noise_last]} if cols['noise_info'][j] else 'N/A',
+                '_tokens': np.asarray(cols['tokens'][tok_first:tok_last]),
+            })
+
+        metadata = self.file_info(fn)
+        metadata['segments'] = segments
+
+        return metadata
+
+
+@lru_cache(maxsize=4)
+def open_index(index_dir):
+    # one index instance per process and directory
+    return Metadata_Index(index_dir)
+
+
+def load_metadata(voxmm_dir, fn, index_dir=None):
+    # metadata of a file, from the metadata index if given, otherwise from its JSON
+    if index_dir:
+        index = open_index(index_dir)
+        index.check_source(voxmm_dir, fn)
+        metadata = index.metadata(fn)
+    else:
+        with open(os.path.join(voxmm_dir,'metadata',fn+'.json'), 'r') as fm:
+            metadata = json.load(fm)
+    cu.version_check(metadata['metadata_version'])
+
+    return metadata
+
+
+def metadata_columns(metadata):
+    # segment columns of a parsed metadata JSON, laid out like Metadata_Index.columns, with the file's speaker and noise tables
+    speakers = {}
+    noises = {}
+    segments = metadata['segments']
+    face_tracks = [[(track['index'], track['timestamp'][0], track['timestamp'][1]) for track in seg['face_track']] for seg in segments]
+    noise_codes = [[] if seg['background_noise']=='N/A' else [noises.setdefault(n, len(noises)) for n in seg['background_noise'].keys()] for seg in segments]
+    tokens = [tu.segment_tokens(seg) for seg in segments]
+
+    cols = {'segment_index': np.array([seg['segment_index'] for seg in segments], dtype=np.int64),
+            'start': np.array([seg['start'] for seg in segments], dtype=np.float64),
+            'end': np.array([seg['end'] for seg in segments], dtype=np.float64),
+            'speaker': np.array([speakers.setdefault(seg['speaker_id'], len(speakers)) for seg in segments], dtype=np.int32),
+            'singing': np.array([bool(seg['singing']) for seg in segments], dtype=bool),
+            'overlapped_duration': np.array([seg['overlapped_duration'] for seg in segments], dtype=np.float64),
+            'on_screen': np.array([bool(seg['on-screen']) for seg in segments], dtype=bool),
+            'noise_info': np.array([seg['background_noise']!='N/A' for seg in segments], dtype=bool)}
+    cols['face_track_offsets'], face_track_values = ragged(face_tracks, np.float64)
+    face_track_values = face_track_values.reshape(-1,3)
+    cols['face_track_index'] = face_track_values[:,0].astype(np.int64)
+    cols['face_track_start'] = face_track_values[:,1]
+    cols['face_track_end'] = face_track_values[:,2]
+    cols['noise_offsets'], cols['noise_code'] = ragged(noise_codes, np.int32)
+    cols['token_offsets'] = np.zeros(len(tokens)+1, dtype=np.int64)
+    cols['token_offsets'][1:] = np.cumsum([len(t) for t in tokens])
+    cols['tokens'] = np.concatenate(tokens+[np.zeros((0,4), dtype=np.int32)]).astype(np.int32)
+
+    return cols, list(speakers.keys()), list(noises.keys())
+
+
+def load_columns(voxmm_dir, fn, index_dir=None):
+    # (file info, segment columns, speaker table, noise table) of a file, from the metadata index if given
+    if index_dir:
+        index = open_index(index_dir)
+        index.check_source(voxmm_dir, fn)
+        info = index.file_info(fn)
+        cu.version_check(info['metadata_version'])
+
+        return info, index.columns(fn), index.speakers, index.noises
+
+    metadata = load_metadata(voxmm_dir, fn)
+    info = {k: v for k, v in metadata.items() if k!='segments'}
+
+    return (info,) + metadata_columns(metadata)
@@ -0,0 +1,109 @@
+import os, glob, json, hashlib
+
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from utils import profile_utils as pu
+
+
+def config_hash(args, keys):
+    # hash of the options an output depends on
+    config = json.dumps({k: getattr(args, k, None) for k in keys}, sort_keys=True)
+
+    return hashlib.sha1(config.encode()).hexdigest()[:16]
+
+
+def segment_hash(segment):
+    # hash of the metadata fields the outputs of a segment are made from
+    fields = json.dumps([segment['start'], segment['end'], segment['text'], [track['index'] for track in segment['face_track']]])
+
+    return hashlib.sha1(fields.encode()).hexdigest()[:16]
+
+
+def write_text(path, text):
+    # written under a temporary name, so a killed process never leaves a truncated file behind
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, obj):
+    write_text(path, json.dumps(obj))
+
+
+def manifest_path(manifest_dir, fn, part=None):
+    # <fn>.json, or <fn>.part<k>.json for the k-th shard of a file split across workers
+    return os.path.join(manifest_dir, fn+'.json' if part is None else f'{fn}.part{part}.json')
+
+
+def part_paths(manifest_dir, fn):
+    return sorted(glob.glob(os.path.join(glob.escape(manifest_dir), glob.escape(fn)+'.part*.json')))
+
+
+def load_segments(paths):
+    # segment entries of manifests, later paths override earlier ones
+    segments = {}
+    for path in paths:
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                segments.update(json.load(f)['segments'])
+
+    return segments
+
+
+def merge_parts(manifest_dir, fn, configs, resume=False, paths=None):
+    # folds the part manifests written by the shards of a file into its manifest and removes the parts
+    previous = [manifest_path(manifest_dir, fn)] + part_paths(manifest_dir, fn) if resume else []
+    manifest = Manifest(manifest_dir, fn, configs)
+    manifest.segments = load_segments(previous + list(paths or []))
+    manifest.save()
+
+    return manifest
+
+
+class Manifest():
+    # completed outputs of a file: segment index -> stage -> {'path', 'size', 'config', 'segment', ...}.
+    # an entry is valid while its stage config and segment hashes match and its output file keeps the recorded size.
+    # a shard of a file (part) keeps the entries of its own segments only, the parent merges the parts afterwards.
+    def __init__(self, manifest_dir, fn, configs, resume=False, segment_idxs=None, part=None):
+        self.manifest_dir = manifest_dir
+        self.fn = fn
+        self.part = part
+        self.path = manifest_path(manifest_dir, fn, part)
+        self.configs = configs # stage -> config hash
+        self.segments = {}
+        if resume:
+            self.segments = load_segments([manifest_path(manifest_dir, fn)] + part_paths(manifest_dir, fn))
+        if not segment_idxs is None:
+            segment_idxs = set([str(i) for i in segment_idxs])
+            self.segments = {k: v for k, v in self.segments.items() if k in segment_idxs}
+
+    def entry(self, segment, stage, path):
+        entry = self.segments.get(str(segment['segment_index']), {}).get(stage)
+        if entry is None or entry['path']!=path or entry['config']!=self.configs[stage] or entry['segment']!=segment_hash(segment):
+            return None
+        if entry['size'] is not None and (not os.path.isfile(path) or os.path.getsize(path)!=entry['size']):
+            return None
+
+        return entry
+
+    def is_done(self, segment, stage, path):
+        return not self.entry(segment, stage, path) is None
+
+    def add(self, segment, stage, path, check_size=True, **extra):
+        entry = {'path': path, 'size': os.path.getsize(path) if check_size else None, 'config': self.configs[stage], 'segment': segment_hash(segment)}
+        entry.update(extra)
+        self.segments.setdefault(str(segment['segment_index']), {})[stage] = entry
+
+    def remove(self, segment, stage):
+        self.segments.get(str(segment['segment_index']), {}).pop(stage, None)
+
+    def save(self):
+        with pu.stage('manifest write'):
+            os.makedirs(self.manifest_dir, exist_ok=True)
+            write_json(self.path, {'configs': self.configs, 'segments': self.segments})
+            # the whole file manifest supersedes parts left by an earlier sharded run
+            if self.part is None:
+                for path in part_paths(self.manifest_dir, self.fn):
+                    os.remove(path)
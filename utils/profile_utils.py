@@ -0,0 +1,159 @@
+import os, json, time, threading, cProfile, contextlib
+from collections import Counter
+
+PROFILE_MODES = ['none', 'stages', 'cprofile']
+
+_profiler = None # stage profiler of this process, None while profiling is off
+_cprofile = None # function level profiler of this process in cprofile mode
+_cprofile_path = None
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Profiler():
+    # mergeable stage timers and counters.
+    # every process times its own stages, workers return theirs with their results and the parent sums them with +=.
+    def __init__(self):
+        self.time = Counter() # stage -> seconds spent in the stage
+        self.calls = Counter() # stage -> times the stage was entered
+        self.counts = Counter() # counter -> value, e.g. frames or bytes
+        self.lock = threading.Lock()
+
+    def add(self, name, elapsed):
+        # stages may be timed from writer threads too
+        with self.lock:
+            self.time[name] += elapsed
+            self.calls[name] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+    def __iadd__(self, other):
+        if not other is None:
+            self.time.update(other.time)
+            self.calls.update(other.calls)
+            self.counts.update(other.counts)
+
+        return self
+
+    def __getstate__(self):
+        state = dict(vars(self))
+        del state['lock']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def to_dict(self, wall_time=None, num_worker=None):
+        return {
+            'wall_time': wall_time,
+            'num_worker': num_worker,
+            'stages': {name: {'time': self.time[name], 'calls': self.calls[name], 'mean': self.time[name]/max(self.calls[name],1)}
+                       for name in sorted(self.time, key=lambda k: -self.time[k])},
+            'counters': dict(sorted(self.counts.items())),
+        }
+
+    def save_json(self, path, wall_time=None, num_worker=None):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(wall_time, num_worker), f, indent=2)
+
+    def save_csv(self, path):
+        with open(path, 'w') as f:
+            f.write('type,name,time,calls,value\n')
+            for name, stage in self.to_dict()['stages'].items():
+                f.write(f"stage,{name},{stage['time']:.6f},{stage['calls']},\n")
+            for name, value in sorted(self.counts.items()):
+                f.write(f"counter,{name},,,{value}\n")
+
+    def print_summary(self, wall_time=None):
+        print('\nProfile (busy time summed over processes and threads, nested stages also count in the enclosing stage)')
+        if not wall_time is None:
+            print(f'- wall time: {wall_time:.2f} s')
+        for name, stage in self.to_dict()['stages'].items():
+            print(f"- {name}: {stage['time']:.2f} s, {stage['calls']} calls, {stage['mean']*1000:.3f} ms/call")
+        for name, value in sorted(self.counts.items()):
+            print(f'- {name}: {value}')
+
+
+class Stage_Timer():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add(self.name, time.perf_counter()-self.begin)
+
+
+class Task():
+    # wraps a pool task. in cprofile mode the function statistics of the process so far are dumped after every task,
+    # as pool processes exit without a hook to dump them at the end.
+    def __enter__(self):
+        if not _cprofile is None:
+            _cprofile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not _cprofile is None:
+            _cprofile.disable()
+            _cprofile.dump_stats(_cprofile_path)
+
+
+def enable(mode='stages', profile_dir=None, name='worker'):
+    # starts profiling in this process. with a profile_dir, cprofile mode also dumps <name>.<pid>.prof there
+    global _profiler, _cprofile, _cprofile_path
+    if not mode in PROFILE_MODES:
+        raise Exception(f"Invalid profile mode: {mode}")
+    _profiler = None if mode=='none' else Profiler()
+    _cprofile = None
+    if mode=='cprofile' and not profile_dir is None:
+        os.makedirs(profile_dir, exist_ok=True)
+        _cprofile = cProfile.Profile()
+        _cprofile_path = os.path.join(profile_dir, f'{name}.{os.getpid()}.prof')
+
+
+def enabled():
+    return not _profiler is None
+
+
+def stage(name):
+    # times the enclosed block as stage name, does nothing while profiling is off
+    if _profiler is None:
+        return _NULL_STAGE
+
+    return Stage_Timer(_profiler, name)
+
+
+def count(name, n=1):
+    if not _profiler is None:
+        _profiler.count(name, n)
+
+
+def collect():
+    # stage timings of this process since the last collect, returned by workers with their results
+    global _profiler
+    if _profiler is None:
+        return None
+    profiler = _profiler
+    _profiler = Profiler()
+
+    return profiler
+
+
+def report(profiler, profile_dir, name, wall_time=None, num_worker=None):
+    # <name>.json and <name>.csv in profile_dir, and a summary on stdout
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler.save_json(os.path.join(profile_dir, name+'.json'), wall_time, num_worker)
+    profiler.save_csv(os.path.join(profile_dir, name+'.csv'))
+    profiler.print_summary(wall_time)
+    print(f'Profile saved to {profile_dir}')
+
+
+def profile_dir(args):
+    # reports and cProfile dumps go to PROFILE_DIR, OUTPUT_DIR/profile if empty
+    return args.profile_dir if args.profile_dir else os.path.join(args.output_dir, 'profile')
@@ -0,0 +1,76 @@
+import math
+
+# relative processing cost, in units of one second of selected audio
+_SEGMENT_COST = 2 # per segment, output files opened and written
+_VIDEO_SEGMENT_COST = 50 # per face track video, encoder started
+_PIXEL_COST = 5e-6 # per decoded source pixel
+_VIDEO_PIXEL_RATE = 25*1280*720 # decoded pixels per second assumed for every source video, which is not probed
+_SHARD_SHARE = 0.5 # files costing more than this share of one worker's load are split into shards
+_BUNDLES_PER_WORKER = 8 # light tasks are packed into bundles of about total cost / (workers * this)
+
+
+def segment_cost(segment, video=False):
+    # video: whether face track videos are generated
+    duration = segment['end'] - segment['start']
+    cost = _SEGMENT_COST + duration
+    if video:
+        cost += _VIDEO_SEGMENT_COST + duration*_VIDEO_PIXEL_RATE*_PIXEL_COST
+
+    return cost
+
+
+def split_shards(segments, costs, max_cost, max_shards):
+    # splits the segments of a file, in time order, into at most max_shards contiguous shards of about equal cost
+    total = sum(costs)
+    shard_num = min(max_shards, len(segments), max(1, math.ceil(total/max_cost))) if max_cost>0 else 1
+    if shard_num<=1:
+        return [list(range(len(segments)))]
+
+    order = sorted(range(len(segments)), key=lambda i: segments[i]['start'])
+    shards = [[] for _ in range(shard_num)]
+    acc = 0
+    for i in order:
+        shards[min(int(acc*shard_num/total), shard_num-1)].append(i)
+        acc += costs[i]
+
+    return [shard for shard in shards if len(shard)>0]
+
+
+def bundle_tasks(costs, target):
+    # groups task indices into bundles, largest first. tasks costing at least target are dispatched alone,
+    # lighter ones are packed together up to target, so the pool is not flooded with tiny tasks.
+    bundles = []
+    packed = []
+    packed_cost = 0
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        if costs[i]>=target:
+            bundles.append(([i], costs[i]))
+            continue
+        packed.append(i)
+        packed_cost += costs[i]
+        if packed_cost>=target:
+            bundles.append((packed, packed_cost))
+            packed = []
+            packed_cost = 0
+    if len(packed)>0:
+        bundles.append((packed, packed_cost))
+
+    return [bundle for bundle, _ in sorted(bundles, key=lambda b: -b[1])]
+
+
+def schedule(files, num_worker, max_shards=1):
+    # files: list of (segments, video) per file, see segment_cost. returns bundles of (file idx, segment idxs) tasks,
+    # the heaviest bundles first so no large file is left to run alone at the end.
+    costs = [[segment_cost(seg, video) for seg in segments] for segments, video in files]
+    total = sum([sum(c) for c in costs])
+    max_cost = total/max(num_worker,1)*_SHARD_SHARE
+    tasks = []
+    task_costs = []
+    for f, (segments, video) in enumerate(files):
+        for shard in split_shards(segments, costs[f], max_cost, max_shards):
+            tasks.append((f, shard))
+            task_costs.append(sum([costs[f][i] for i in shard]))
+
+    bundles = bundle_tasks(task_costs, total/max(num_worker*_BUNDLES_PER_WORKER,1))
+
+    return [[tasks[i] for i in bundle] for bundle in bundles]
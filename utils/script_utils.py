@@ -1,6 +1,12 @@
 import os, glob, shutil, argparse, yaml, re, json
 
-PATTERN = r'![^!]*!|\{[^}]*\}|\([^/][^)]*\)|\[[^\]]*\]|<[^>]*>|[\w\'.]+'
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from utils import transcript_utils as tu
+from utils.transcript_utils import PATTERN, TOKEN_RE
+
+_CACHE_SIZE = 100000 # transformed tokens kept per generator
 
 
 class Script_Generator():
@@ -37,9 +43,9 @@ class Script_Generator():
         self.interj2token = interjection_to_token if isinstance(interjection_to_token,list) else interjection_to_token.replace("[","").replace("]","").replace(" ","").split(',')
         self.interj2drop = interjection_to_drop if isinstance(interjection_to_drop,list) else interjection_to_drop.replace("[","").replace("]","").replace(" ","").split(',')
 
-        self.interj2word = [w.strip().lower() for w in self.interj2word]
-        self.interj2token = [w.strip().lower() for w in self.interj2token]
-        self.interj2drop = [w.strip().lower() for w in self.interj2drop]
+        self.interj2word = set(w.strip().lower() for w in self.interj2word)
+        self.interj2token = set(w.strip().lower() for w in self.interj2token)
+        self.interj2drop = set(w.strip().lower() for w in self.interj2drop)
 
         self.inaud_token = inaudible_token
         self.uncert_token = uncertain_token
@@ -47,136 +53,149 @@ class Script_Generator():
         self.interj_token = interjection_token
         self.tokens = [inaudible_token, uncertain_token, diffluency_token, interjection_token]
 
-
-    def numeric_process(self, txt):
-        txt_splitted = re.findall(PATTERN, txt)
-        for idx, inst in enumerate(txt_splitted):
-            if '/' in inst:
-                inst = inst.replace('(','').replace(')','')
-                if self.num_format=='pronunciation':
-                    txt_splitted[idx] = inst.split('/')[1].strip()
-                elif self.num_format=='digit':
-                    txt_splitted[idx] = inst.split('/')[0].strip()
-                else:
-                    raise Exception(f'Invalid numeric format: {self.num_format}')
-
-        return ' '.join(txt_splitted)
-
-    def abbreviation_process(self, txt):
-        txt_splitted = re.findall(PATTERN, txt)
-        for idx, inst in enumerate(txt_splitted):
-            if '!' in inst:
-                inst = inst.replace('!','').strip()
-                txt_splitted[idx] = ' '.join(list(inst)) if self.abb_space else inst
-
-        return ' '.join(txt_splitted)
-
-    def inaudible_process(self, txt):
-        if self.inaud_proc=='drop':
-            return txt.replace('(inaudible)','').strip()
-
-        elif self.inaud_proc=='token':
-            return txt.replace('(inaudible)',self.inaud_token).strip()
-
-        else:
+        # per token action table, resolved once from the config.
+        # each action maps a label to its replacement text (None to drop it, True to keep it as a word).
+        actions = {'word': True, 'drop': None}
+        if not self.num_format in ['pronunciation', 'digit']:
+            raise Exception(f'Invalid numeric format: {self.num_format}')
+        if not self.inaud_proc in ['drop', 'token']:
             raise Exception(f'Invalid inaudible process setting: {self.inaud_proc}')
-
-    def uncertain_process(self, txt):
-        txt_splitted = re.findall(PATTERN, txt)
-        new_txt = []
-        for inst in txt_splitted:
-            if '[' in inst:
-                inst = inst.replace('[','').replace(']','').strip()
-                if self.uncert_proc=='word':
-                    new_txt.append(inst)
-
-                elif self.uncert_proc=='drop':
-                    continue
-
-                elif self.uncert_proc=='token':
-                    new_txt.append(self.uncert_token)
-
-                else:
-                    raise Exception(f'Invalid uncertain process setting: {self.uncert_proc}')
-
+        if not self.uncert_proc in ['word', 'drop', 'token']:
+            raise Exception(f'Invalid uncertain process setting: {self.uncert_proc}')
+        if not self.diff_proc in ['word', 'drop', 'token']:
+            raise Exception(f'Invalid difflency process setting: {self.diff_proc}')
+        if not self.interj_proc in ['word', 'drop', 'token']:
+            raise Exception(f'Invalid interjection process setting: {self.interj_proc}')
+        self.inaud_action = '' if self.inaud_proc=='drop' else self.inaud_token
+        self.uncert_action = actions.get(self.uncert_proc, self.uncert_token)
+        self.diff_action = actions.get(self.diff_proc, self.diff_token)
+        self.interj_action = actions.get(self.interj_proc, self.interj_token)
+
+        # applied to every token in this order, as the former passes over the whole text were
+        self.stages = [self.abbreviation, self.diffluency, self.inaudible, self.interjection, self.uncertain, self.numeric]
+        self.cache = {}
+
+    # token level stages: return None if the token is unchanged, otherwise its replacement text
+    def numeric(self, inst):
+        if '/' in inst:
+            inst = inst.replace('(','').replace(')','')
+            return inst.split('/')[1 if self.num_format=='pronunciation' else 0].strip()
+
+    def abbreviation(self, inst):
+        if '!' in inst:
+            inst = inst.replace('!','').strip()
+            return ' '.join(list(inst)) if self.abb_space else inst
+
+    def inaudible(self, inst):
+        if '(inaudible)' in inst:
+            return inst.replace('(inaudible)',self.inaud_action)
+
+    def uncertain(self, inst):
+        if '[' in inst:
+            return self.label_action(inst.replace('[','').replace(']','').strip(), self.uncert_action)
+
+    def diffluency(self, inst):
+        if '<' in inst and not inst in self.tokens:
+            return self.label_action(inst.replace('<','').replace('>','').strip(), self.diff_action)
+
+    def interjection(self, inst):
+        if '{' in inst:
+            inst = inst.replace('{','').replace('}','').strip().lower()
+            if inst in self.interj2word:
+                return inst
+            elif inst in self.interj2drop:
+                return ''
+            elif inst in self.interj2token:
+                return self.interj_token
+
+            return self.label_action(inst, self.interj_action)
+
+    @staticmethod
+    def label_action(inst, action):
+        if action is True:
+            return inst
+        elif action is None:
+            return ''
+
+        return action
+
+    def transform_token(self, inst, stage=0):
+        # runs the remaining stages on a single token. the text replacing a token is split into
+        # tokens again for the later stages, as the former passes did by re-parsing the whole text.
+        key = (inst, stage)
+        if key in self.cache:
+            return self.cache[key]
+
+        txt = inst
+        for i in range(stage, len(self.stages)):
+            replaced = self.stages[i](inst)
+            if replaced is None:
+                continue
+            if i==len(self.stages)-1:
+                txt = replaced
             else:
-                new_txt.append(inst)
-
-        return ' '.join(new_txt)
-
-
-    def diffluency_process(self, txt):
-        txt_splitted = re.findall(PATTERN, txt)
-        new_txt = []
-        for inst in txt_splitted:
-            if '<' in inst and not inst in self.tokens:
-                inst = inst.replace('<','').replace('>','').strip()
-                if self.diff_proc=='word':
-                    new_txt.append(inst)
+                txt = ' '.join([self.transform_token(t, i+1) for t in TOKEN_RE.findall(replaced)])
+            break
 
-                elif self.diff_proc=='drop':
-                    continue
+        if stage==0:
+            # case, apostrophe and hypen are per character and can be applied per token
+            txt = txt.upper() if self.capitalize else txt.lower()
+            txt = txt if self.apostrophe else txt.replace("'","")
+            txt = txt if self.hypen else txt.replace("-"," ")
 
-                elif self.diff_proc=='token':
-                    new_txt.append(self.diff_token)
+        if len(self.cache)>_CACHE_SIZE:
+            self.cache.clear()
+        self.cache[key] = txt
 
-                else:
-                    raise Exception(f'Invalid difflency process setting: {self.diff_proc}')
+        return txt
 
-            else:
+    def apply_stage(self, stage, txt):
+        new_txt = []
+        for inst in TOKEN_RE.findall(txt):
+            replaced = stage(inst)
+            if replaced is None:
                 new_txt.append(inst)
+            elif replaced!='':
+                new_txt.append(replaced)
 
         return ' '.join(new_txt)
 
+    def numeric_process(self, txt):
+        return self.apply_stage(self.numeric, txt)
 
-    def interjection_process(self, txt):
-        txt_splitted = re.findall(PATTERN, txt)
-        new_txt = []
-        for inst in txt_splitted:
-            if '{' in inst:
-                inst = inst.replace('{','').replace('}','').strip().lower()
-                if inst in self.interj2word:
-                    new_txt.append(inst)
-
-                elif inst in self.interj2drop:
-                    continue
-
-                elif inst in self.interj2token:
-                    new_txt.append(self.interj_token)
-
-                else:
-                    if self.interj_proc=='word':
-                        new_txt.append(inst)
-
-                    elif self.interj_proc=='drop':
-                        continue
-
-                    elif self.interj_proc=='token':
-                        new_txt.append(self.interj_token)
+    def abbreviation_process(self, txt):
+        return self.apply_stage(self.abbreviation, txt)
 
-                    else:
-                        raise Exception(f'Invalid interjection process setting: {self.diff_proc}')
+    def inaudible_process(self, txt):
+        return txt.replace('(inaudible)',self.inaud_action).strip()
 
-            else:
-                new_txt.append(inst)
+    def uncertain_process(self, txt):
+        return self.apply_stage(self.uncertain, txt)
 
-        return ' '.join(new_txt)
+    def diffluency_process(self, txt):
+        return self.apply_stage(self.diffluency, txt)
 
+    def interjection_process(self, txt):
+        return self.apply_stage(self.interjection, txt)
 
-    def __call__(self, txt):
-        txt = self.abbreviation_process(txt)
-        txt = self.diffluency_process(txt)
-        txt = self.inaudible_process(txt)
-        txt = self.interjection_process(txt)
-        txt = self.uncertain_process(txt)
-        txt = self.numeric_process(txt)
-        txt = txt.upper() if self.capitalize else txt.lower()
-        txt = txt if self.apostrophe else txt.replace("'","")
-        txt = txt if self.hypen else txt.replace("-"," ")
+    def __call__(self, txt, tokens=None):
+        # tokens: output of transcript_utils.lex(txt), if already parsed
+        if tokens is None:
+            tokens = tu.lex(txt)
+        txt = ' '.join([self.transform_token(inst) for inst in tu.token_strings(txt, tokens)])
         txt = ' '.join(txt.split()).strip() # delete double space
 
         return txt
 
+    def batch(self, txts, tokens=None):
+        # normalizes many transcripts at once; repeated transcripts are processed only once
+        results = {}
+        for i, txt in enumerate(txts):
+            if not txt in results:
+                results[txt] = self(txt, None if tokens is None else tokens[i])
+
+        return [results[txt] for txt in txts]
+
 
 if __name__=="__main__":
     script_generator = Script_Generator(capitalize=True, 
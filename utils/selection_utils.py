@@ -0,0 +1,151 @@
+import os, json
+from collections import Counter
+import numpy as np
+
+EXCLUSION_REASONS = ['singing', 'overlap', 'off-screen', 'partially on-screen', 'scene changed on-screen', 'inaudible', 'uncertain', 'interjection', 'diffluency', 'duration', 'word count']
+
+_SEGMENT_BIN = 1 # sec, bin width of the selected segment duration histogram
+_SPEAKER_BIN = 60 # sec, bin width of the per-speaker selected duration histogram
+_TRACK_MARGIN = 0.01 # sec, face track may start later or end earlier than its segment by this much
+
+
+def add_sums(counter, codes, values, names):
+    # counter[names[code]] += sum of values per code present in codes
+    present, inverse = np.unique(codes, return_inverse=True)
+    for code, v in zip(present.tolist(), np.bincount(inverse, weights=values, minlength=len(present)).tolist()):
+        counter[names[code]] += v
+
+
+def filter_segments(cols, args, noises):
+    # non-script filters evaluated as masks over all segments of a file.
+    # returns the exclusion reason of each segment, '' if it passes. conditions are listed in the order they are checked,
+    # so a segment failing several of them is attributed to the first one.
+    n = len(cols['start'])
+    start = np.asarray(cols['start'])
+    end = np.asarray(cols['end'])
+    duration = end - start
+    on_screen = np.asarray(cols['on_screen'])
+
+    track_num = np.diff(cols['face_track_offsets'])
+    track_seg = np.repeat(np.arange(n), track_num)
+    partial_track = (np.asarray(cols['face_track_start'])-start[track_seg]>_TRACK_MARGIN) | (end[track_seg]-np.asarray(cols['face_track_end'])>_TRACK_MARGIN)
+    partial = np.bincount(track_seg[partial_track], minlength=n)>0
+
+    noise_seg = np.repeat(np.arange(n), np.diff(cols['noise_offsets']))
+    # matched against the option string, like `n in args.background_noise_list`
+    noise_codes = [c for c, noise in enumerate(noises) if noise in args.background_noise_list]
+    noisy = np.bincount(noise_seg[np.isin(cols['noise_code'], noise_codes)], minlength=n)>0
+
+    conditions = [
+        (duration>=args.max_duration) | (duration<=args.min_duration),
+        np.asarray(cols['singing']) & args.no_singing,
+        (np.asarray(cols['overlapped_duration'])>0) & args.no_overlap,
+        on_screen & (track_num!=1) & args.no_multiple_on_screen,
+        on_screen & partial & args.no_partially_on_screen,
+        ~on_screen & args.only_on_screen,
+        noisy & args.no_overlap,
+    ]
+    reasons = ['duration', 'singing', 'overlap', 'scene changed on-screen', 'partially on-screen', 'off-screen', 'background noise']
+
+    return np.select(conditions, reasons, default='').astype(object)
+
+
+class Selection_Statistics():
+    # mergeable accumulator of segment selection results.
+    # per file statistics are built in the workers and summed with += in the parent.
+    def __init__(self):
+        self.file_cnt = 0
+        self.total_cnt = 0
+        self.total_duration = 0
+        self.total_onscreen_duration = 0
+        self.selected_cnt = 0
+        self.selected_duration = 0
+        self.selected_onscreen_duration = 0
+
+        self.spk_duration = Counter() # speaker -> duration of all segments
+        self.selected_spk_duration = Counter() # speaker -> duration of selected segments
+        self.excluded_duration = Counter() # reason -> excluded duration
+        self.excluded_cnt = Counter() # reason -> excluded segment num
+        self.segment_histogram = Counter() # duration bin -> selected segment num
+
+    def add_file(self, metadata):
+        self.file_cnt += 1
+        self.total_cnt += metadata['statistics']['segment_num']
+        self.total_duration += metadata['statistics']['utterance_duration']
+        self.total_onscreen_duration += metadata['statistics']['on-screen_duration']
+
+    def add_segments(self, cols, reasons, speakers):
+        # cols: segment columns of a file (see index_utils), reasons: '' if the segment is selected, otherwise the reason it is excluded
+        duration = np.asarray(cols['end']) - np.asarray(cols['start'])
+        spk = np.asarray(cols['speaker'])
+        selected = reasons==''
+        add_sums(self.spk_duration, spk, duration, speakers)
+        add_sums(self.selected_spk_duration, spk[selected], duration[selected], speakers)
+
+        self.selected_cnt += int(selected.sum())
+        self.selected_duration += float(duration[selected].sum())
+        self.selected_onscreen_duration += float(duration[selected & np.asarray(cols['on_screen'])].sum())
+        bins, cnts = np.unique((duration[selected]//_SEGMENT_BIN).astype(int), return_counts=True)
+        self.segment_histogram.update(dict(zip(bins.tolist(), cnts.tolist())))
+
+        names, inverse = np.unique(reasons[~selected].astype(str), return_inverse=True)
+        add_sums(self.excluded_duration, inverse, duration[~selected], names.tolist())
+        self.excluded_cnt.update(dict(zip(names.tolist(), np.bincount(inverse, minlength=len(names)).tolist())))
+
+    def __iadd__(self, other):
+        for k, v in vars(other).items():
+            if isinstance(v, Counter):
+                getattr(self, k).update(v)
+            else:
+                setattr(self, k, getattr(self, k) + v)
+
+        return self
+
+    def speaker_histogram(self):
+        # selected duration bin -> speaker num
+        return Counter(int(d//_SPEAKER_BIN) for d in self.selected_spk_duration.values())
+
+    def to_dict(self):
+        return {
+            'total': {
+                'file_num': self.file_cnt,
+                'segment_num': self.total_cnt,
+                'duration': self.total_duration,
+                'on-screen_duration': self.total_onscreen_duration,
+                'speaker_num': len(self.spk_duration),
+            },
+            'selected': {
+                'segment_num': self.selected_cnt,
+                'duration': self.selected_duration,
+                'on-screen_duration': self.selected_onscreen_duration,
+                'speaker_num': len(self.selected_spk_duration),
+                'speaker_duration': dict(sorted(self.selected_spk_duration.items())),
+                'segment_duration_histogram': {f'{b*_SEGMENT_BIN}-{(b+1)*_SEGMENT_BIN}s': self.segment_histogram[b] for b in sorted(self.segment_histogram)},
+                'speaker_duration_histogram': {f'{b*_SPEAKER_BIN}-{(b+1)*_SPEAKER_BIN}s': n for b, n in sorted(self.speaker_histogram().items())},
+            },
+            'excluded': {
+                reason: {'segment_num': self.excluded_cnt[reason], 'duration': self.excluded_duration[reason]}
+                for reason in EXCLUSION_REASONS + sorted(set(self.excluded_cnt) - set(EXCLUSION_REASONS))
+            },
+        }
+
+    def save_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def print_summary(self, file_list_path):
+        print(f'\nResults for {file_list_path}')
+        print(f'\nTotal segments in file list ({file_list_path})')
+        print(f'- total segment num: {self.total_cnt}')
+        print(f'- total segment duration: {self.total_duration/3600:.2f} hrs')
+        print(f'- total speaker: {len(self.spk_duration)}')
+
+        print('\nSelected Segments')
+        print(f'- total segment num: {self.selected_cnt}')
+        print(f'- total segment duration: {self.selected_duration/3600:.2f} hrs')
+        print(f'- total speaker: {len(self.selected_spk_duration)}')
+
+        print('\nExcluded Segments')
+        for reason in EXCLUSION_REASONS:
+            print(f'- {reason}: {self.excluded_duration[reason]/60:.2f} mins')
+        print('\n','='*20)
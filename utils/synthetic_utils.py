@@ -0,0 +1,167 @@
+import os, json
+import cv2
+import soundfile
+import numpy as np
+
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from utils import common_utils as cu
+
+# synthetic VoxMM-shaped dataset for benchmarks: metadata, face track JSON, wav and mp4 files following the 1.0.x schema.
+# contents are random but deterministic for a seed, and only their shape resembles the real corpus.
+
+METADATA_VERSION = cu.VERSION.replace('x','0')
+
+_WORDS = ['the', 'and', 'i', 'you', 'it', 'that', 'we', 'know', 'what', 'so', 'yeah', 'think', 'going', 'people', 'really',
+          "don't", "it's", "that's", 'right', 'well', 'time', 'because', 'something', 'actually', 'never', 'about', 'world']
+# markup tokens with their share among tokens
+_MARKUPS = [
+    (0.02, lambda rng: '!{}!'.format(pick(rng, ['tv', 'bbc', 'usa', 'dna']))),
+    (0.02, lambda rng: '({}/{})'.format(*pick(rng, [('1.5', 'one point five'), ('2.5', 'two point five'), ('1990', 'nineteen ninety')]))),
+    (0.01, lambda rng: '(inaudible)'),
+    (0.02, lambda rng: '[{}]'.format(' '.join([pick(rng, _WORDS) for _ in range(rng.integers(1,4))]))),
+    (0.04, lambda rng: '{{{}}}'.format(pick(rng, ['uh', 'um', 'hmm', 'mhm', 'uh-huh', 'erm', 'yeah']))),
+    (0.02, lambda rng: '<{}>'.format(pick(rng, ['th th', 'w we', 'i i']))),
+    (0.01, lambda rng: '({})'.format(pick(rng, ['laughs', 'applause']))),
+    (0.002, lambda rng: 'f***'),
+]
+_NOISES = ['music', 'laughter', 'applause', 'crowd']
+
+
+def pick(rng, options):
+    return options[rng.integers(len(options))]
+
+
+def make_text(rng, duration):
+    # about 2.5 tokens per second
+    tokens = []
+    for _ in range(max(1, int(duration*2.5))):
+        p = rng.random()
+        for share, markup in _MARKUPS:
+            if p<share:
+                tokens.append(markup(rng))
+                break
+            p -= share
+        else:
+            tokens.append(pick(rng, _WORDS))
+
+    return ' '.join(tokens)
+
+
+def make_timeline(rng, duration):
+    # (start, end) of utterances over duration seconds, mostly one after another with some overlapping
+    timeline = []
+    timeline_end = 0
+    while True:
+        if len(timeline)>0 and rng.random()<0.1:
+            start = timeline[-1][0] + rng.uniform(0, timeline[-1][1]-timeline[-1][0])
+        else:
+            start = timeline_end + rng.uniform(0.1, 1.5)
+        end = start + rng.uniform(0.5, 8)
+        if end>=duration:
+            return timeline
+        timeline.append((round(start,3), round(end,3)))
+        timeline_end = max(timeline_end, end)
+
+
+def make_bbox(rng, frame_num):
+    # (frame_num, 4) bboxes drifting around a random position, some of them crossing the frame edge
+    size = rng.uniform(0.15, 0.4)
+    center = rng.uniform(0.1, 0.9, 2) + np.cumsum(rng.normal(0, 0.002, (frame_num, 2)), axis=0)
+
+    return np.concatenate([center-size/2, center+size/2], axis=1)
+
+
+def make_file(fn, index, duration, fps, speaker_num, rng):
+    # (metadata, face track json) of a recording of duration seconds
+    speakers = ['id{:05d}'.format(i) for i in rng.choice(10000, speaker_num, replace=False)]
+    timeline = make_timeline(rng, duration)
+    segments = []
+    face_tracks = []
+    for i, (start, end) in enumerate(timeline):
+        overlapped = sum([max(0, min(end, e)-max(start, s)) for j, (s, e) in enumerate(timeline) if j!=i and s<end and e>start])
+        on_screen = bool(rng.random()<0.7)
+        face_track = []
+        if on_screen:
+            # mostly one track over the segment, sometimes a track cut short or a scene change
+            bounds = [start, end]
+            if rng.random()<0.1:
+                bounds = [start, (start+end)/2, end]
+            elif rng.random()<0.1:
+                bounds = [start+rng.uniform(0, (end-start)/2), end]
+            for track_start, track_end in zip(bounds[:-1], bounds[1:]):
+                frame = np.arange(int(track_start*fps), int(track_end*fps)+1)
+                face_tracks.append({'track_index': len(face_tracks), 'frame': frame.tolist(), 'bbox': np.round(make_bbox(rng, len(frame)),4).tolist(),
+                                    'time_stamp': (frame/fps).tolist()})
+                face_track.append({'index': face_tracks[-1]['track_index'], 'timestamp': [track_start, track_end]})
+        noise = 'N/A' if rng.random()<0.8 else {pick(rng, _NOISES): 1}
+        segments.append({
+            'segment_index': i,
+            'start': start,
+            'end': end,
+            'speaker_id': pick(rng, speakers),
+            'text': make_text(rng, end-start),
+            'singing': bool(rng.random()<0.02),
+            'overlapped_duration': round(overlapped,3),
+            'on-screen': on_screen,
+            'face_track': face_track,
+            'background_noise': noise,
+        })
+
+    metadata = {
+        'metadata_version': METADATA_VERSION,
+        'video_infos': {'file_name': fn, 'index': index},
+        'statistics': {
+            'utterance_duration': sum([seg['end']-seg['start'] for seg in segments]),
+            'on-screen_duration': sum([seg['end']-seg['start'] for seg in segments if seg['on-screen']]),
+            'segment_num': len(segments),
+        },
+        'segments': segments,
+    }
+
+    return metadata, {'FPS': fps, 'face_tracks': face_tracks}
+
+
+def write_wav(path, duration, sample_rate, rng):
+    # speech-like noise bursts over a low hum
+    t = np.arange(int(duration*sample_rate))/sample_rate
+    envelope = np.repeat(rng.random(int(duration*4)+1)>0.3, sample_rate//4+1)[:len(t)]
+    wav = 0.05*np.sin(2*np.pi*120*t) + 0.2*envelope*rng.standard_normal(len(t))
+    soundfile.write(path, wav.astype(np.float32), sample_rate, 'PCM_16')
+
+
+def write_video(path, duration, fps, width, height):
+    # a moving gradient, cheap to encode
+    gradient = np.add.outer(np.arange(height), np.arange(width))
+    base = np.stack([gradient%256, (gradient*2)%256, (255-gradient)%256], axis=-1).astype(np.uint8)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    try:
+        for i in range(int(duration*fps)):
+            writer.write(np.roll(base, i, axis=1))
+    finally:
+        writer.release()
+
+
+def make_dataset(voxmm_dir, num_file, duration, fps=25, width=320, height=240, sample_rate=16000, speaker_num=8, seed=0):
+    # VOXMM_DIR/{metadata,face_track,wav,video}/synNNNN.* and split/all.txt listing the files
+    rng = np.random.default_rng(seed)
+    for d in ['metadata', 'face_track', 'wav', 'video', 'split']:
+        os.makedirs(os.path.join(voxmm_dir, d), exist_ok=True)
+
+    file_list = []
+    for index in range(num_file):
+        fn = 'syn{:04d}'.format(index)
+        metadata, face_track = make_file(fn, index, duration, fps, speaker_num, rng)
+        with open(os.path.join(voxmm_dir, 'metadata', fn+'.json'), 'w') as f:
+            json.dump(metadata, f)
+        with open(os.path.join(voxmm_dir, 'face_track', fn+'.json'), 'w') as f:
+            json.dump(face_track, f)
+        write_wav(os.path.join(voxmm_dir, 'wav', fn+'.wav'), duration, sample_rate, rng)
+        write_video(os.path.join(voxmm_dir, 'video', fn+'.mp4'), duration, fps, width, height)
+        file_list.append(fn)
+
+    with open(os.path.join(voxmm_dir, 'split', 'all.txt'), 'w') as f:
+        f.write(''.join([fn+'\n' for fn in file_list]))
+
+    return file_list
@@ -0,0 +1,86 @@
+import re
+from functools import lru_cache
+import numpy as np
+
+PATTERN = r'![^!]*!|\{[^}]*\}|\([^/][^)]*\)|\[[^\]]*\]|<[^>]*>|[\w\'.]+'
+TOKEN_RE = re.compile(PATTERN)
+WORD_RE = re.compile(r'\w+')
+
+# token type codes
+WORD = 0
+ABBREVIATION = 1 # !tv!
+PAREN = 2 # (laughs)
+NUMERIC = 3 # (1.0/one point o)
+INAUDIBLE = 4 # (inaudible)
+UNCERTAIN = 5 # [i don't know]
+INTERJECTION = 6 # {hmm}
+DIFFLUENCY = 7 # <th th>
+MASKED = 8 # token containing '*'
+
+_CACHE_SIZE = 100000 # transcripts kept by lex
+
+
+def token_type(inst):
+    # markup contained in a token is checked in this order, e.g. [<th>] is an uncertain word
+    if inst=='(inaudible)':
+        return INAUDIBLE
+    elif '[' in inst:
+        return UNCERTAIN
+    elif '{' in inst:
+        return INTERJECTION
+    elif '<' in inst:
+        return DIFFLUENCY
+    elif '(' in inst and '/' in inst:
+        return NUMERIC
+    elif '*' in inst:
+        return MASKED
+    elif inst[0]=='!':
+        return ABBREVIATION
+    elif inst[0]=='(':
+        return PAREN
+
+    return WORD
+
+
+def word_count(inst, typ):
+    # number of words a token stands for
+    if typ==WORD:
+        return len(WORD_RE.findall(inst))
+    elif typ==UNCERTAIN:
+        return len(inst.replace("[","").replace("]","").split())
+    elif typ==INTERJECTION:
+        return len(inst.replace("{","").replace("}","").split())
+    elif typ==DIFFLUENCY:
+        return len(inst.replace("<","").replace(">","").split())
+    elif typ==NUMERIC:
+        return len(inst.replace("(","").replace(")","").split("/")[-1].split())
+    elif typ==MASKED:
+        return 0
+
+    return 1
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def lex(txt):
+    # parses a VoxMM transcript once into a read-only (N,4) int32 array of [type, start, end, word count]
+    tokens = []
+    for m in TOKEN_RE.finditer(txt):
+        inst = m.group()
+        typ = token_type(inst)
+        tokens.append((typ, m.start(), m.end(), word_count(inst, typ)))
+    tokens = np.array(tokens, dtype=np.int32).reshape(-1,4)
+    tokens.setflags(write=False)
+
+    return tokens
+
+
+def segment_tokens(segment):
+    # tokens of segment['text'], cached in the segment itself
+    if not '_tokens' in segment:
+        segment['_tokens'] = lex(segment['text'])
+
+    return segment['_tokens']
+
+
+def token_strings(txt, tokens):
+    return [txt[start:end] for start, end in tokens[:,1:3].tolist()]
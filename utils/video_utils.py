@@ -1,15 +1,19 @@
 import cv2
 import os
 import random
+import re
 import json
 import soundfile
-import librosa
 import subprocess
+import tempfile
+import threading
 import numpy as np
 from multiprocessing import Pool
+from functools import lru_cache
 
 from utils import wav_utils as wu
 from utils import common_utils as cu
+from utils import profile_utils as pu
 
 
 def get_frames(cap):
@@ -24,14 +28,218 @@ def get_frames(cap):
     return frames
 
 
-def resample_frames(frames, src_fps, trg_fps):
-    src_len = len(frames)
-    trg_len = int(src_len*trg_fps/src_fps)
-    resampled = []
-    for trg_f in range(trg_len):
-        resampled.append(frames[min(int(trg_f*src_fps/trg_fps),src_len-1)])
+def video_info(path):
+    # (fps, width, height, frame count) from the container header, without decoding
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise Exception(f"Cannot open video: {path}")
+    info = (cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    cap.release()
 
-    return resampled
+    return info
+
+
+class OpenCV_Frame_Source():
+    # frames of a video decoded by cv2.VideoCapture at source resolution.
+    # seek is skipped when the requested frame is the next one anyway.
+    def __init__(self, path, height=0, threads=0):
+        # resizing after decoding adds work instead of saving it, only ffmpeg scales while decoding
+        if height>0:
+            raise Exception(f"decode_height needs frame_source: ffmpeg, opencv decodes at source resolution. {path}")
+        if threads>0:
+            self.cap = cv2.VideoCapture(path, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, threads])
+        else:
+            self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise Exception(f"Cannot open video: {path}")
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.pos = 0
+
+    def seek(self, idx):
+        if idx!=self.pos:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
+            self.pos = idx
+
+    def grab(self):
+        # skips a frame without converting it
+        ret = self.cap.grab()
+        if ret:
+            self.pos += 1
+
+        return ret
+
+    def read(self):
+        ret, frame = self.cap.read()
+        if not frame is None:
+            self.pos += 1
+
+        return ret, frame
+
+    def close(self):
+        self.cap.release()
+
+
+@lru_cache(maxsize=None)
+def ffmpeg_version():
+    # (major, minor) of the ffmpeg binary, None for builds without a release number
+    try:
+        out = subprocess.check_output(['ffmpeg', '-version'], stderr=subprocess.DEVNULL).decode(errors='ignore')
+    except Exception:
+        return None
+    m = re.search(r'ffmpeg version n?(\d+)\.(\d+)', out)
+
+    return (int(m.group(1)), int(m.group(2))) if m else None
+
+
+def passthrough_option():
+    # -fps_mode replaced -vsync in ffmpeg 5.1. git builds without a release number are taken as recent
+    version = ffmpeg_version()
+
+    return ['-vsync', 'passthrough'] if not version is None and version<(5,1) else ['-fps_mode', 'passthrough']
+
+
+class FFmpeg_Frame_Source():
+    # frames of a video decoded by an ffmpeg process and read as raw BGR from a pipe.
+    # ffmpeg scales to height while decoding and decodes with threads; seeking restarts the process at the frame.
+    def __init__(self, path, height=0, threads=0):
+        self.path = path
+        self.threads = threads
+        # set before probing, close() runs from __del__ even when probing fails
+        self.proc = None
+        self.stderr = None
+        # frame numbering follows the container header like OpenCV_Frame_Source
+        self.fps, src_width, src_height, self.frame_count = video_info(path)
+        self.width, self.height = scaled_size(src_width, src_height, height)
+        self.scaled = self.height!=src_height
+        self.pos = 0
+        self.skip_buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)
+
+    def start(self):
+        cmd = ['ffmpeg', '-loglevel', 'error', '-threads', str(self.threads)]
+        if self.pos>0:
+            # half a frame early, so the first frame passed on is frame pos
+            cmd += ['-ss', '{:.6f}'.format((self.pos-0.5)/self.fps)]
+        cmd += ['-i', self.path, '-map', '0:v:0'] + passthrough_option()
+        if self.scaled:
+            cmd += ['-vf', f'scale={self.width}:{self.height}:flags=area']
+        cmd += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+        # stderr goes to a file rather than a pipe, so ffmpeg never blocks on it while frames are read
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=self.stderr)
+
+    def check_exit(self):
+        # called when the pipe ends. the end of the video, unless ffmpeg failed
+        ret = self.proc.wait()
+        if ret!=0:
+            self.stderr.seek(0)
+            err = self.stderr.read().decode(errors='ignore').strip()
+            raise Exception(f"video decoding failed with exit code {ret}. {self.path} {err}")
+
+    def seek(self, idx):
+        if idx!=self.pos:
+            self.close()
+            self.pos = idx
+
+    def read_into(self, frame):
+        if self.proc is None:
+            self.start()
+        buffer = memoryview(frame).cast('B')
+        filled = 0
+        while filled<len(buffer):
+            n = self.proc.stdout.readinto(buffer[filled:])
+            if not n:
+                self.check_exit()
+                return False
+            filled += n
+        self.pos += 1
+
+        return True
+
+    def grab(self):
+        # skipped frames are still decoded by ffmpeg, but only copied out of the pipe
+        return self.read_into(self.skip_buffer)
+
+    def read(self):
+        frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        if not self.read_into(frame):
+            return False, None
+
+        return True, frame
+
+    def close(self):
+        if not self.proc is None:
+            self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.stderr.close()
+            self.proc = None
+
+    def __del__(self):
+        self.close()
+
+
+def scaled_size(width, height, trg_height=0):
+    # (width, height) scaled down to trg_height keeping the aspect ratio with an even width, unchanged if trg_height is 0 or not smaller
+    if trg_height<=0 or trg_height>=height:
+        return width, height
+
+    return max(2, int(round(width*trg_height/height/2))*2), trg_height
+
+
+def open_frame_source(path, frame_source='opencv', height=0, threads=0):
+    if frame_source=='opencv':
+        return OpenCV_Frame_Source(path, height, threads)
+    elif frame_source=='ffmpeg':
+        return FFmpeg_Frame_Source(path, height, threads)
+    else:
+        raise Exception(f"Invalid frame source: {frame_source}")
+
+
+class Frame_Resampler():
+    # frame rate conversion by nearest frame selection, fed one source frame at a time.
+    # calling it with the next source frame returns how many times the frame appears in the output.
+    def __init__(self, src_len, src_fps, trg_fps):
+        self.src_len = src_len
+        self.src_fps = src_fps
+        self.trg_fps = trg_fps
+        self.trg_len = int(src_len*trg_fps/src_fps)
+        self.src_f = 0
+        self.trg_f = 0
+
+    def __call__(self, frame=None):
+        repeat = 0
+        while self.trg_f<self.trg_len and min(int(self.trg_f*self.src_fps/self.trg_fps),self.src_len-1)==self.src_f:
+            self.trg_f += 1
+            repeat += 1
+        self.src_f += 1
+
+        return repeat
+
+
+def resample_frames(frames, src_fps, trg_fps, src_len=None):
+    # generator; src_len is required when frames has no len()
+    resampler = Frame_Resampler(len(frames) if src_len is None else src_len, src_fps, trg_fps)
+    for frame in frames:
+        for _ in range(resampler(frame)):
+            yield frame
+        if resampler.trg_f>=resampler.trg_len:
+            break
+
+
+def plan_decode_intervals(frame_ranges, max_gap=0):
+    # merge inclusive [first, last] frame ranges into decode intervals.
+    # gaps up to max_gap frames are read through instead of seeking over them.
+    intervals = []
+    for first, last in sorted(frame_ranges):
+        if len(intervals)>0 and first<=intervals[-1][1]+max_gap+1:
+            intervals[-1][1] = max(intervals[-1][1], last)
+        else:
+            intervals.append([first, last])
+
+    return intervals
 
 
 def crop_frame(frame, bbox, frame_size=None, padding=True):
@@ -54,20 +262,22 @@ def crop_frame(frame, bbox, frame_size=None, padding=True):
 
             
     if not frame_size is None:
-        cropped_frame = cv2.resize(cropped_frame,frame_size)
+        with pu.stage('frame resize'):
+            cropped_frame = cv2.resize(cropped_frame,frame_size)
     
     return cropped_frame
 
 
 def convert_video(args):
-    src_path, output_path, fps = args
-    cmd = f"ffmpeg -y -i '{src_path}' -c:v libx264 -crf 18 -preset veryslow -r {fps} '{output_path}'"
+    src_path, output_path, fps, preset, crf = args
+    cmd = f"ffmpeg -y -i '{src_path}' -c:v libx264 -crf {crf} -preset {preset} -r {fps} '{output_path}'"
     print(f"Converting {src_path} to {output_path}...")
     if subprocess.check_call(cmd,shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)!=0:
         raise Exception(f"Converting failed. {src_path}")
 
 
-def convert_videos(src_dir, output_dir, fps, num_processes=32):
+def convert_videos(src_dir, output_dir, fps, num_processes=32, preset='veryslow', crf=18):
+    # re-encodes the videos at a fixed frame rate. not needed by Face_Track_Generator, which resamples frames itself.
     if not os.path.isdir(src_dir):
         print(f"Source directory '{src_dir}' does not exist.")
         return
@@ -79,7 +289,7 @@ def convert_videos(src_dir, output_dir, fps, num_processes=32):
         if file.endswith('.mp4'):
             src_file = os.path.join(src_dir, file)
             output_file = os.path.join(output_dir, os.path.splitext(file)[0] + '.mp4')
-            tasks.append((src_file, output_file, fps))
+            tasks.append((src_file, output_file, fps, preset, crf))
 
     with Pool(num_processes) as pool:
         pool.map(convert_video, tasks)
@@ -87,6 +297,166 @@ def convert_videos(src_dir, output_dir, fps, num_processes=32):
     print("Conversion completed.")
 
 
+def encoder_options(video_codec, frame_size, fps):
+    # mpeg4 follows cv2.VideoWriter with mp4v (bit rate and GOP), so the output matches the opencv writer
+    if video_codec=='mpeg4':
+        return ['-b:v', str(int(frame_size[0]*frame_size[1]*fps*1.5)), '-g', '12']
+    elif video_codec=='libx264':
+        return ['-preset', 'ultrafast']
+
+    return []
+
+
+class Video_Writer():
+    # streams raw BGR frames (and optionally float32 PCM audio) into a single ffmpeg process
+    # that encodes and muxes the final mp4 directly, without temporary files.
+    def __init__(self,
+        output_path,
+        frame_size,
+        fps,
+        audio=None,
+        sample_rate=None,
+        video_codec="mpeg4",
+        audio_codec="aac",
+        ):
+        self.output_path = output_path
+        self.audio_thread = None
+        self.error = ''
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(*frame_size), '-r', str(fps), '-i', 'pipe:0']
+        pass_fds = ()
+        if not audio is None:
+            audio_r, audio_w = os.pipe()
+            pass_fds = (audio_r,)
+            cmd += ['-f', 'f32le', '-ar', str(sample_rate), '-ac', '1', '-i', f'pipe:{audio_r}']
+        cmd += ['-c:v', video_codec, '-pix_fmt', 'yuv420p'] + encoder_options(video_codec, frame_size, fps)
+        if not audio is None:
+            cmd += ['-c:a', audio_codec]
+        cmd += [output_path]
+
+        # stderr goes to a file rather than a pipe nobody reads while frames are written, which could fill up and block ffmpeg
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.stderr, pass_fds=pass_fds)
+        if not audio is None:
+            os.close(audio_r)
+            # ffmpeg reads both inputs interleaved, so audio is fed from its own thread
+            self.audio_thread = threading.Thread(target=self.feed_audio, args=(audio_w, np.ascontiguousarray(audio, dtype=np.float32)), daemon=True)
+            self.audio_thread.start()
+
+    @staticmethod
+    def feed_audio(fd, audio):
+        try:
+            with open(fd, 'wb') as f:
+                f.write(memoryview(audio).cast('B'))
+        except BrokenPipeError:
+            pass
+
+    def write(self, frame):
+        # blocks while ffmpeg is busy, so this is where the encoding time shows
+        try:
+            with pu.stage('video encode'):
+                self.proc.stdin.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+        except BrokenPipeError:
+            self.close()
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        with pu.stage('video mux'):
+            ret = self.proc.wait()
+            if not self.audio_thread is None:
+                self.audio_thread.join()
+        if ret!=0 and not self.stderr.closed:
+            self.stderr.seek(0)
+            self.error = self.stderr.read().decode(errors='ignore').strip()
+        self.stderr.close()
+        if ret!=0:
+            raise Exception(f"video encoding failed. {self.output_path} {self.error}")
+
+    def abort(self):
+        self.proc.kill()
+        self.close_quietly()
+        if os.path.isfile(self.output_path):
+            os.remove(self.output_path)
+
+    def close_quietly(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class OpenCV_Video_Writer():
+    # writes frames with cv2.VideoWriter, then muxes the audio in with ffmpeg through temporary files
+    def __init__(self,
+        output_path,
+        frame_size,
+        fps,
+        codec=cv2.VideoWriter_fourcc(*'mp4v'),
+        audio=None,
+        sample_rate=None,
+        ):
+        vid_nm, vid_ext = os.path.splitext(output_path)
+        self.output_path = output_path
+        self.tmp_wav_path = output_path.replace(vid_ext,"_t.wav")
+        self.tmp_vid_path = output_path.replace(vid_ext,'_t'+vid_ext)
+        self.audio = audio
+        self.sr = sample_rate
+
+        if not audio is None:
+            self.out_writer = cv2.VideoWriter(self.tmp_vid_path, codec, fps, frame_size)
+        else:
+            self.out_writer = cv2.VideoWriter(output_path, codec, fps, frame_size)
+
+    def write(self, frame):
+        with pu.stage('video encode'):
+            self.out_writer.write(frame)
+
+    def close(self):
+        try:
+            with pu.stage('video encode'):
+                self.out_writer.release()
+            if not self.audio is None:
+                with pu.stage('video mux'):
+                    soundfile.write(self.tmp_wav_path, self.audio, self.sr,'PCM_24')
+                    
+                    cmd = 'ffmpeg -y -i {} -i {} -c:v copy -c:a aac {}'.format(self.tmp_vid_path,self.tmp_wav_path,self.output_path)
+                    if subprocess.check_call(cmd,shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)!=0:
+                        raise Exception(f"merging audio & video failed. {self.output_path}")
+
+        finally:            
+            if os.path.isfile(self.tmp_wav_path):
+                os.remove(self.tmp_wav_path)
+            if os.path.isfile(self.tmp_vid_path):
+                os.remove(self.tmp_vid_path)
+
+    def abort(self):
+        self.out_writer.release()
+        for path in [self.tmp_wav_path, self.tmp_vid_path, self.output_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
 class Face_Track_Generator():
     def __init__(self,
         video_path,
@@ -95,21 +465,28 @@ class Face_Track_Generator():
         track_size=256,
         track_framerate=25,
         codec=cv2.VideoWriter_fourcc(*'mp4v'),
+        video_writer="ffmpeg",
+        video_codec="mpeg4",
+        frame_source="opencv",
+        decode_height=0,
+        decode_threads=0,
         **kwargs
         ):      
         if os.path.isfile(video_path): 
-            self.cap = cv2.VideoCapture(video_path)
+            self.cap = open_frame_source(video_path, frame_source, decode_height, decode_threads)
             self.src_nm, self.src_ext = os.path.splitext(os.path.basename(video_path))
             self.src_path = video_path
 
         else:
             raise Exception(f"File not exist: {video_path}")  
             
-        self.W = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.H = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.fps = int(self.cap.get(cv2.CAP_PROP_FPS))
-        self.src_len = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.W = self.cap.width
+        self.H = self.cap.height
+        self.fps = int(self.cap.fps)
+        self.src_len = self.cap.frame_count
         self.codec = codec
+        self.video_writer = video_writer
+        self.video_codec = video_codec
 
         with open(face_track_json_path,'r') as f:
             face_track_json = json.load(f)
@@ -122,19 +499,20 @@ class Face_Track_Generator():
         self.trg_fps = int(track_framerate)
         self.audio_in_track = False
         
-    def load_audio_from_path(self, audio_path, sample_rate):
+    def load_audio_from_path(self, audio_path, sample_rate, resampler='soxr', quality='high', cache=None):
         if not os.path.isfile(audio_path):
             print(f"Cannot find wav file from path {audio_path}. Extract tmp wav from video")
             audio_path = self.src_path.replace(self.src_ext,'_t.wav')
             wu.save_wav_from_video(self.src_path, audio_path, sample_rate)
             print(f"Tmp wav extraction completed. {self.src_path} => {audio_path}")
-            self.src_wav, self.sr = librosa.load(audio_path,sr=sample_rate)
+            self.src_wav, self.sr = wu.load_wav(audio_path, sample_rate, resampler, quality)
             os.remove(audio_path)
             print(f"Tmp wav removed. {audio_path}")
             self.audio_in_track = True
 
         else:
-            self.src_wav, self.sr = librosa.load(audio_path,sr=sample_rate)
+            self.src_wav = wu.Audio_Source(audio_path, sample_rate, resampler, quality, cache)
+            self.sr = self.src_wav.sr
             self.audio_in_track = True
 
     def load_audio(self, np_audio, sample_rate, **kwargs):
@@ -143,71 +521,145 @@ class Face_Track_Generator():
         self.audio_in_track = True
 
     
+    def frame_range(self, start, end):
+        return max(int(start*self.fps),0), min(int(end*self.fps),self.src_len-1)
+
+    def crop_track_frame(self, track_id, idx, src_frame):
+        with pu.stage('frame crop'):
+            bbox = cu.face_track_bbox(self.face_tracks[track_id], idx)
+
+            return crop_frame(src_frame, bbox, self.trg_size)
+
     def get_face_crop(self, track_id, start, end):
-        face_track = self.face_tracks[track_id]
-        src_idxs = [f for f in range(self.src_len) if f>=int(start*self.fps) and f<=int(end*self.fps)]
-        f_first = min(list(face_track.keys()))
-        f_last = max(list(face_track.keys()))
-        face_crops = []
+        # generator of cropped and resampled frames; only the current frame is held in memory
+        src_idxs = range(max(int(start*self.fps),0), min(int(end*self.fps),self.src_len-1)+1)
+        resampler = Frame_Resampler(len(src_idxs), self.fps, self.trg_fps)
         for idx in src_idxs:
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-            _, src_frame = self.cap.read()
+            with pu.stage('frame decode'):
+                self.cap.seek(idx)
+                _, src_frame = self.cap.read()
 
             try:
                 if src_frame is None:
                     raise Exception(f"No frame detected in the video. {track_id} {start}~{end}")
-                bbox = face_track[min(max(idx,f_first),f_last)]
-                face_crops.append(crop_frame(src_frame, bbox, self.trg_size))
+                face_crop = self.crop_track_frame(track_id, idx, src_frame)
                 
-            except:       
+            except Exception as e:
                 raise Exception(f"face cropping failed. {str(e)}")
-        
-        if self.fps!=self.trg_fps:
-            face_crops = resample_frames(face_crops, self.fps, self.trg_fps)
-            
-        return face_crops
+
+            for _ in range(resampler(face_crop)):
+                yield face_crop
+
+    def write_face_tracks(self, windows, max_gap=0, volume=-16):
+        # windows: list of (key, track_id, start, end, output_path)
+        # decode every planned interval once and stream each frame to the writers of all windows covering it.
+        # yields (key, error) as soon as the output of a window is finished.
+        pending = []
+        for key, track_id, start, end, output_path in windows:
+            first, last = self.frame_range(start, end)
+            if first>last:
+                try:
+                    self.save_video([], output_path, self.crop_track_audio(start, end, volume))
+                    yield key, None
+                except Exception as e:
+                    yield key, str(e)
+            else:
+                pending.append((first, last, key, track_id, start, end, output_path))
+        pending.sort(key=lambda w: w[0])
+        intervals = plan_decode_intervals([(w[0], w[1]) for w in pending], max_gap)
+
+        pos = -1
+        nxt = 0
+        active = []
+        for interval_start, interval_end in intervals:
+            idx = interval_start
+            while idx<=interval_end:
+                if pos!=idx:
+                    with pu.stage('frame seek'):
+                        self.cap.seek(idx)
+
+                while nxt<len(pending) and pending[nxt][0]<=idx:
+                    first, last, key, track_id, start, end, output_path = pending[nxt]
+                    nxt += 1
+                    try:
+                        writer = self.open_writer(output_path, self.crop_track_audio(start, end, volume))
+                    except Exception as e:
+                        yield key, f"video saving failed. {str(e)}"
+                        continue
+                    active.append((last, key, track_id, writer, Frame_Resampler(last-first+1, self.fps, self.trg_fps)))
+
+                decode_error = None
+                with pu.stage('frame decode'):
+                    try:
+                        if len(active)==0:
+                            # nothing covers this frame, skip it without converting to BGR
+                            ret, src_frame = self.cap.grab(), None
+                        else:
+                            ret, src_frame = self.cap.read()
+                            ret = ret and not src_frame is None
+                    except Exception as e:
+                        ret, decode_error = False, str(e)
+
+                if not ret:
+                    # only the windows covering the missing frame fail. decoding resumes with a seek to the next window
+                    for last, key, track_id, writer, resampler in active:
+                        writer.abort()
+                        yield key, decode_error if decode_error else f"No frame detected in the video. track {track_id}, frame {idx}"
+                    active = []
+                    pos = -1
+                    idx = pending[nxt][0] if nxt<len(pending) else interval_end+1
+                    continue
+
+                finished = []
+                for window in active:
+                    last, key, track_id, writer, resampler = window
+                    try:
+                        face_crop = self.crop_track_frame(track_id, idx, src_frame)
+                        for _ in range(resampler(face_crop)):
+                            writer.write(face_crop)
+                        if idx==last:
+                            writer.close()
+                            finished.append((window, None))
+                    except Exception as e:
+                        writer.abort()
+                        finished.append((window, f"video saving failed. {str(e)}"))
+
+                for window, error in finished:
+                    active.remove(window)
+                    yield window[1], error
+                idx += 1
+                pos = idx
         
                 
-    def save_video(self, frames, output_path, audio=None):
+    def open_writer(self, output_path, audio=None):
         # audio: numpy audio 
-        vid_nm, vid_ext = os.path.splitext(output_path)
-        tmp_wav_path = output_path.replace(vid_ext,"_t.wav")
-        tmp_vid_path = output_path.replace(vid_ext,'_t'+vid_ext)
-        frames_len = len(frames)
-        
-        if not audio is None and self.audio_in_track:
-            out_writer = cv2.VideoWriter(tmp_vid_path, self.codec, self.trg_fps, self.trg_size)
+        if not self.audio_in_track:
+            audio = None
+        if self.video_writer=='ffmpeg':
+            return Video_Writer(output_path, self.trg_size, self.trg_fps, audio, getattr(self, 'sr', None), self.video_codec)
+        elif self.video_writer=='opencv':
+            return OpenCV_Video_Writer(output_path, self.trg_size, self.trg_fps, self.codec, audio, getattr(self, 'sr', None))
         else:
-            out_writer = cv2.VideoWriter(output_path, self.codec, self.trg_fps, self.trg_size)
+            raise Exception(f"Invalid video writer: {self.video_writer}")
 
+    def save_video(self, frames, output_path, audio=None):
+        # frames: any iterable of frames, consumed one at a time
         try:
-            for frame in frames:
-                out_writer.write(frame)
-            out_writer.release()
-            if not audio is None and self.audio_in_track:
-                soundfile.write(tmp_wav_path, audio, self.sr,'PCM_24')
-                
-                cmd = 'ffmpeg -y -i {} -i {} -c:v copy -c:a aac {}'.format(tmp_vid_path,tmp_wav_path,output_path)
-                if subprocess.check_call(cmd,shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)!=0:
-                    raise Exception(f"merging audio & video failed. {output_path}")
-        
+            with self.open_writer(output_path, audio) as writer:
+                for frame in frames:
+                    writer.write(frame)
+
         except Exception as e:
             raise Exception(f"video saving failed. {str(e)}")
-        
-        finally:            
-            if os.path.isfile(tmp_wav_path):
-                os.remove(tmp_wav_path)
-            if os.path.isfile(tmp_vid_path):
-                os.remove(tmp_vid_path)
-                
-    def __call__(self, track_id, start, end, output_path, volume=-16):
-        face_crops = self.get_face_crop(track_id, start, end)
+
+    def crop_track_audio(self, start, end, volume=-16):
         if self.audio_in_track:
-            wav_crop = wu.crop_wav(self.src_wav, start, end, self.sr, volume)
-            self.save_video(face_crops, output_path, wav_crop)
-            del wav_crop
+            with pu.stage('audio crop'):
+                return wu.crop_wav(self.src_wav, start, end, self.sr, volume)
 
-        else:
-            self.save_video(face_crops, output_path)
-        del face_crops
+    def __call__(self, track_id, start, end, output_path, volume=-16):
+        self.save_video(self.get_face_crop(track_id, start, end), output_path, self.crop_track_audio(start, end, volume))
+
+    def close(self):
+        self.cap.close()
 
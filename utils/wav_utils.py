@@ -1,11 +1,76 @@
-import os, glob, shutil, argparse, yaml, re, json
-import librosa
+import os, glob, shutil, argparse, yaml, re, json, math, hashlib
 import soundfile
 import subprocess
+import threading
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+from utils import common_utils as cu
+from utils import profile_utils as pu
 
 _TARGET_VOLUME = -16 # dBFS
 _SAMPLE_RATE = 16000 # Hz
+_RESAMPLER = 'soxr'
+_RESAMPLE_QUALITY = 'high'
+_RESAMPLE_PAD = 0.05 # sec, context resampled around a window and dropped, so the window matches resampling the whole file
+_CACHE_SIZE = 50 # GB
+_WRITER_THREADS = 4
+_WRITER_PENDING = 16 # segments held in memory waiting to be written
+_MIN_RMS = 1e-8 # segments quieter than this are treated as silent and not normalized
+
+# resampling quality presets per backend. librosa is imported only when it is selected.
+# scipy presets are (filter half length in zero crossings, kaiser beta); the cost grows with the filter length.
+RESAMPLE_QUALITIES = {
+    'soxr': {'low': 'LQ', 'medium': 'MQ', 'high': 'HQ', 'very_high': 'VHQ'},
+    'scipy': {'low': (4, 5.0), 'medium': (8, 7.0), 'high': (16, 9.0), 'very_high': (32, 12.0)},
+    'librosa': {'low': 'soxr_lq', 'medium': 'soxr_mq', 'high': 'soxr_hq', 'very_high': 'soxr_vhq'},
+}
+
+
+@lru_cache(maxsize=16)
+def polyphase_filter(up, down, half_len, beta):
+    # low pass FIR for resample_poly, built like its default filter but with half_len zero crossings instead of 10
+    from scipy.signal import firwin
+    max_rate = max(up, down)
+
+    return firwin(2*half_len*max_rate+1, 1.0/max_rate, window=('kaiser', beta))
+
+
+def resample(wav, src_sr, trg_sr, resampler=_RESAMPLER, quality=_RESAMPLE_QUALITY):
+    if src_sr==trg_sr:
+        return wav
+    if not resampler in RESAMPLE_QUALITIES:
+        raise Exception(f"Invalid resampler: {resampler}")
+    if not quality in RESAMPLE_QUALITIES[resampler]:
+        raise Exception(f"Invalid resample quality: {quality}")
+    quality = RESAMPLE_QUALITIES[resampler][quality]
+
+    with pu.stage('audio resample'):
+        if resampler=='soxr':
+            import soxr
+            return soxr.resample(wav, src_sr, trg_sr, quality=quality)
+
+        elif resampler=='scipy':
+            from scipy.signal import resample_poly
+            gcd = math.gcd(src_sr, trg_sr)
+            up, down = trg_sr//gcd, src_sr//gcd
+            return resample_poly(wav, up, down, window=polyphase_filter(up, down, *quality)).astype(wav.dtype)
+
+        elif resampler=='librosa':
+            import librosa
+            return librosa.resample(wav, orig_sr=src_sr, target_sr=trg_sr, res_type=quality)
+
+
+def load_wav(path, sr=_SAMPLE_RATE, resampler=_RESAMPLER, quality=_RESAMPLE_QUALITY):
+    # whole wav file as mono float32 at the target sample rate, like librosa.load
+    with Audio_Source(path, sr, resampler, quality) as src_wav:
+        return src_wav[:], src_wav.sr
+
 
 def normalize_volume(wav, target_rms):
     current_rms = np.sqrt(np.mean(wav**2))
@@ -13,15 +78,48 @@ def normalize_volume(wav, target_rms):
 
     return wav * scaling_factor
 
-def crop_wav(src_wav, start, end, sr=_SAMPLE_RATE, volume=_TARGET_VOLUME, trg_path=None):
+def check_bounds(wav_len, start, end, sr=_SAMPLE_RATE):
+    # sample range of a segment, raises if it runs past the wav
     start = int(start*sr)
     end = int(end*sr)
-    if end>len(src_wav):
-        raise Exception(f"end timestamp longer than wav length: {end} vs {len(src_wav)}")
+    if end>wav_len:
+        raise Exception(f"end timestamp longer than wav length: {end} vs {wav_len}")
+
+    return start, end
 
-    cropped_wav = src_wav[start:end]
+
+def crop_wavs(src_wav, segments, sr=_SAMPLE_RATE, volume=_TARGET_VOLUME):
+    # yields (i, normalized wav) for the (start, end) segments, empty ones first and the rest ordered by start.
+    # segments are read per merged span, and their RMS comes from one cumulative sum of squares over the span.
+    bounds = [check_bounds(len(src_wav), start, end, sr) for start, end in segments]
     target_rms = db2linear(volume)
-    normalized_wav = normalize_volume(cropped_wav, target_rms)
+    for i, (start, end) in enumerate(bounds):
+        if end<=start:
+            yield i, np.asarray(src_wav[start:start])
+
+    order = sorted([i for i, (start, end) in enumerate(bounds) if end>start], key=lambda i: bounds[i])
+    j = 0
+    for span_start, span_end in cu.merge_intervals([bounds[i] for i in order]):
+        span = np.asarray(src_wav[span_start:span_end])
+        with pu.stage('audio normalize'):
+            energy = np.zeros(len(span)+1)
+            np.cumsum(np.square(span, dtype=np.float64), out=energy[1:])
+        while j<len(order) and bounds[order[j]][0]<span_end:
+            i = order[j]
+            start, end = bounds[i][0]-span_start, bounds[i][1]-span_start
+            with pu.stage('audio normalize'):
+                current_rms = np.sqrt(max(energy[end]-energy[start], 0)/(end-start))
+                if current_rms>_MIN_RMS:
+                    wav = span[start:end]*np.float32(target_rms/current_rms)
+                else:
+                    # silent segment is left as is rather than scaled by inf
+                    wav = span[start:end].copy()
+            yield i, wav
+            j += 1
+
+
+def crop_wav(src_wav, start, end, sr=_SAMPLE_RATE, volume=_TARGET_VOLUME, trg_path=None):
+    _, normalized_wav = next(crop_wavs(src_wav, [(start, end)], sr, volume))
 
     if not trg_path is None:
         soundfile.write(trg_path, normalized_wav, sr, 'PCM_24')
@@ -29,6 +127,177 @@ def crop_wav(src_wav, start, end, sr=_SAMPLE_RATE, volume=_TARGET_VOLUME, trg_pa
         return normalized_wav
 
 
+class Audio_Source():
+    # wav file viewed as a mono array at the target sample rate.
+    # slicing seeks into the file and reads (and resamples) only the requested samples, so it can replace a loaded array in crop_wav.
+    def __init__(self, path, sr=_SAMPLE_RATE, resampler=_RESAMPLER, quality=_RESAMPLE_QUALITY, cache=None):
+        self.path = path
+        self.resampler = resampler
+        self.quality = quality
+        self.f = soundfile.SoundFile(path)
+        self.src_sr = self.f.samplerate
+        self.src_len = self.f.frames
+        self.sr = self.src_sr if sr is None else sr
+        # a resampling period is src_step source samples -> trg_step target samples
+        gcd = math.gcd(self.src_sr, self.sr)
+        self.src_step = self.src_sr // gcd
+        self.trg_step = self.sr // gcd
+        self.length = int(math.ceil(self.src_len*self.sr/self.src_sr))
+        # resampled samples memory-mapped from the audio cache, if given. audio read at its own rate is not cached
+        self.cached = None
+        if not cache is None and self.sr!=self.src_sr:
+            with pu.stage('audio cache load'):
+                self.cached = cache.load(self)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, start, end):
+        # source samples [start, end), downmixed by averaging channels
+        start = max(start, 0)
+        end = max(min(end, self.src_len), start)
+        with pu.stage('audio read'):
+            self.f.seek(start)
+            wav = self.f.read(end-start, dtype='float32', always_2d=True)
+        pu.count('audio samples read', len(wav))
+
+        return wav.mean(axis=1) if wav.shape[1]>1 else wav[:,0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or not key.step in [None, 1]:
+            raise Exception(f"only contiguous slices can be read from audio source: {key}")
+        start, end, _ = key.indices(self.length)
+        end = max(start, end)
+        if not self.cached is None:
+            return self.cached[start:end]
+        elif self.sr==self.src_sr:
+            return self.read(start, end)
+
+        # window aligned to resampling periods, so its samples fall on the same time grid as the whole file
+        pad = int(_RESAMPLE_PAD*self.sr)//self.trg_step + 1
+        first = max(start//self.trg_step - pad, 0)
+        last = min(-(-end//self.trg_step) + pad, -(-self.src_len//self.src_step))
+        wav = resample(self.read(first*self.src_step, last*self.src_step), self.src_sr, self.sr, self.resampler, self.quality)
+        offset = start - first*self.trg_step
+
+        return wav[offset:offset+end-start]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Audio_Cache():
+    # on-disk cache of resampled audio. one .npy per wav file (path, mtime, size), sample rate and resampler, read back memory-mapped.
+    # least recently used entries are removed when the cache grows over max_size GB.
+    def __init__(self, cache_dir, max_size=_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size*1024**3
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, source):
+        stat = os.stat(source.path)
+        key = f'{os.path.abspath(source.path)}|{stat.st_mtime_ns}|{stat.st_size}|{source.sr}|{source.resampler}|{source.quality}'
+
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest()+'.npy')
+
+    def load(self, source):
+        path = self.entry_path(source)
+        try:
+            # mtime marks the entry as recently used
+            os.utime(path)
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            pass
+
+        # written under a temporary name, so other processes never read a partial entry
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, source[:])
+            os.replace(tmp_path, path)
+        except:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict(keep=path)
+
+        return np.load(path, mmap_mode='r')
+
+    def evict(self, keep=None):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir,'*.npy')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum([size for _, size, _ in entries])
+        for _, size, path in sorted(entries):
+            if total<=self.max_size:
+                break
+            if path==keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class Async_Writer():
+    # writes audio files on a thread pool, libsndfile encodes without holding the GIL.
+    # submit blocks while max_pending writes are waiting, so finished segments do not pile up in memory.
+    def __init__(self, num_thread=_WRITER_THREADS, max_pending=_WRITER_PENDING):
+        self.executor = ThreadPoolExecutor(num_thread)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'audio_duration': 0, 'bytes': 0, 'write_time': 0}
+
+    def write(self, path, wav, sr, subtype):
+        try:
+            begin = time.time()
+            with pu.stage('wav write'):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                soundfile.write(path, wav, sr, subtype)
+            size = os.path.getsize(path)
+            pu.count('wav bytes written', size)
+            with self.lock:
+                self.stats['files'] += 1
+                self.stats['audio_duration'] += len(wav)/sr
+                self.stats['bytes'] += size
+                self.stats['write_time'] += time.time()-begin
+        finally:
+            self.pending.release()
+
+    def submit(self, path, wav, sr=_SAMPLE_RATE, subtype='PCM_24'):
+        # returns a future, its exception() is the error of the write if any
+        self.pending.acquire()
+        try:
+            return self.executor.submit(self.write, path, wav, sr, subtype)
+        except:
+            self.pending.release()
+            raise
+
+    def close(self):
+        # waits for the pending writes and returns the write statistics
+        self.executor.shutdown(wait=True)
+
+        return dict(self.stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(wait=True)
+
+
 def db2linear(db):
     return 10 ** (db/20)
 